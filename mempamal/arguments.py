@@ -27,6 +27,28 @@ def get_map_argparser():
 
     parser.add_argument("--inner", type=int,
                         help="Inner CV Id")
+    parser.add_argument("--grid",
+                        help="Joblib file with the grid to evaluate "
+                        "(instead of the grid of the dataset)")
+    parser.add_argument("--params", type=int, nargs="+",
+                        help="Indices of the grid parameters to evaluate")
+    parser.add_argument("--checkpoint", action="store_true",
+                        help="Checkpoint the scores after each grid "
+                        "parameter (out.ckpt) to resume a killed job")
+    parser.add_argument("--batch", action="store_true",
+                        help="Evaluate all the inner folds in turn, each "
+                        "one warm started from the previous one (out is a "
+                        "template with {inner})")
+    parser.add_argument("--warm-save",
+                        help="Joblib file to save the fitted estimators "
+                        "of the last fold (warm start)")
+    parser.add_argument("--block", type=int,
+                        help="Feature block Id (see --n-blocks)")
+    parser.add_argument("--n-blocks", type=int,
+                        help="Number of feature blocks (column slices)")
+    parser.add_argument("--stop-file",
+                        help="Skip the job if this file exists "
+                        "(adaptive outer CV)")
 
     # verbose mode
     parser.add_argument("-v", "--verbose", help="verbose mode",
@@ -54,6 +76,60 @@ def get_ired_argparser():
     parser.add_argument("outer", type=int,
                         help="Outer CV Id")
 
+    parser.add_argument("--rounds", type=int, default=1,
+                        help="Number of search rounds to reduce")
+    parser.add_argument("--folds",
+                        help="Joblib file with the folds and the grid "
+                        "(to avoid loading the dataset)")
+    parser.add_argument("--speculative",
+                        help="Joblib file with speculative outer-train "
+                        "results (to avoid the refit)")
+    parser.add_argument("--warm-start",
+                        help="Joblib file with fitted inner estimators to "
+                        "warm start the refit")
+    parser.add_argument("--block", type=int,
+                        help="Feature block Id (see --n-blocks)")
+    parser.add_argument("--n-blocks", type=int,
+                        help="Number of feature blocks (column slices)")
+    parser.add_argument("--stop-file",
+                        help="Skip the job if this file exists "
+                        "(adaptive outer CV)")
+
+    # verbose mode
+    parser.add_argument("-v", "--verbose", help="verbose mode",
+                        action="store_true")
+    return parser
+
+
+def get_prop_argparser():
+    """Build command line arguments parser for a proposer.
+
+    Arguments parser compatible with the commands builder workflows.
+    """
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("crossval",
+                        help="JSON file to configure cross validation scheme")
+    parser.add_argument("method",
+                        help="JSON file to configure the method")
+    parser.add_argument("dataset",
+                        help="Joblib file with data and folds")
+    parser.add_argument("out",
+                        help="Filename to output the proposed grid")
+    parser.add_argument("in",
+                        help="Filename template for input files")
+    parser.add_argument("outer", type=int,
+                        help="Outer CV Id")
+    parser.add_argument("round", type=int,
+                        help="Search round Id")
+
+    parser.add_argument("--folds",
+                        help="Joblib file with the folds and the grid "
+                        "(to avoid loading the dataset)")
+    parser.add_argument("--stop-file",
+                        help="Skip the job if this file exists "
+                        "(adaptive outer CV)")
+
     # verbose mode
     parser.add_argument("-v", "--verbose", help="verbose mode",
                         action="store_true")
@@ -72,6 +148,20 @@ def get_ored_argparser():
     parser.add_argument("in",
                         help="Filename template for input files")
 
+    parser.add_argument("--tol", type=float,
+                        help="Request to stop the adaptive outer CV once "
+                        "the standard error of the mean is below tol")
+    parser.add_argument("--min-folds", type=int, default=2,
+                        help="Minimum number of outer folds before a stop")
+    parser.add_argument("--stop-file",
+                        help="File created to stop the adaptive outer CV")
+    parser.add_argument("--n-blocks", type=int,
+                        help="Number of feature blocks (in is a template "
+                        "with {block})")
+    parser.add_argument("--table",
+                        help="Tab-separated file for the summary of each "
+                        "dataset (or method)")
+
     # verbose mode
     parser.add_argument("-v", "--verbose", help="verbose mode",
                         action="store_true")
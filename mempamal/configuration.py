@@ -8,10 +8,21 @@ import json
 import os.path as path
 import warnings
 
+import numpy as np
 import sklearn.externals.joblib as joblib
 from sklearn.pipeline import Pipeline
 
-from mempamal.crossval import make_folds
+from mempamal.crossval import make_folds, get_fold, encode_folds
+from mempamal.dynamic import (construct_pipeline, get_methods,
+                              get_score_func, method_grid)
+from mempamal.gridsearch import GenericGridSearch
+from mempamal.linear import ENGINES
+from mempamal.preprocessing import compute_fold_stats, write_fold_stats
+from mempamal.search import get_search_conf, initial_grid
+from mempamal.storage import (encode_features, decode_features,
+                              compute_kernel, get_fold_data,
+                              precision_report, store_array,
+                              write_fold_files)
 
 
 def _check_conf(cfg, req_keys, cat=""):
@@ -38,6 +49,15 @@ def _check_cv_conf(cfg):
         req_keys = ["foldsIterator", "funcMetric"]
         _check_conf(cfg, ["gridSearch"], cat="crossval")
         _check_conf(cfg["gridSearch"], req_keys, cat="crossval")
+        if "search" in cfg["gridSearch"]:
+            search = cfg["gridSearch"]["search"]
+            _check_conf(search, ["strategy", "distributions", "budget"],
+                        cat="crossval")
+            if search["strategy"] == "sequential":
+                _check_conf(search, ["n_per_round"], cat="crossval")
+            elif search["strategy"] != "random":
+                raise ValueError("Unknown search strategy: {}".format(
+                        search["strategy"]))
 
 
 def _check_data_conf(cfg):
@@ -52,8 +72,14 @@ def _check_method_conf(cfg):
     """Check the configuration of the data.
 
     """
-    req_keys = ["mapper", "inner_reducer", "outer_reducer", "steps"]
+    req_keys = ["mapper", "inner_reducer", "outer_reducer"]
     _check_conf(cfg, req_keys, cat="method")
+    for name, m_cfg in get_methods(cfg):
+        cat = "method" if name is None else "method ({})".format(name)
+        _check_conf(m_cfg, ["steps"], cat=cat)
+        if m_cfg.get("engine", "generic") not in ENGINES:
+            raise ValueError("Unknown grid search engine: {}".format(
+                    m_cfg["engine"]))
 
 
 def check_conf(cfg, cat="crossval", verbose=False):
@@ -85,7 +111,10 @@ def JSONify_estimator(est,
                       path_to_mr=None,
                       mapper="mapper.py",
                       i_red="inner_reducer.py",
-                      o_red="outer_reducer.py"):
+                      o_red="outer_reducer.py",
+                      proposer="proposer.py",
+                      streaming=False,
+                      engine=None):
     """Helper function to jsonify a sklearn.pipeline.Pipeline or an estimator.
 
     Parameters
@@ -108,6 +137,17 @@ def JSONify_estimator(est,
         script for the inner reducer (for model selection)
     o_red : str, optional (default="outer_reducer.py")
         script for the outer reducer
+    proposer : str, optional (default="proposer.py")
+        script proposing new parameters (for sequential search)
+    streaming : boolean, optional (default=False)
+        the mapper fits, predicts, scores and releases the estimator of
+        each parameter in turn (bounded memory, see
+        GenericGridSearch.fit_score).
+    engine : str in ["generic", "ridge"], optional (default=None,
+             i.e. "generic")
+        grid search engine of the mapper and the inner reducer ("ridge":
+        closed-form solutions for all the alphas of a Ridge or
+        RidgeClassifier final step, see linear.RidgeGridSearch).
 
     Examples:
     ---------
@@ -156,6 +196,7 @@ def JSONify_estimator(est,
     ]
   ],
   "outer_reducer": "./outer_reducer.py",
+  "proposer": "./proposer.py",
   "est_param": "logit__C"
 }
     """
@@ -183,6 +224,52 @@ def JSONify_estimator(est,
     conf["mapper"] = path.join(path_to_mr, mapper)
     conf["inner_reducer"] = path.join(path_to_mr, i_red)
     conf["outer_reducer"] = path.join(path_to_mr, o_red)
+    conf["proposer"] = path.join(path_to_mr, proposer)
+    if streaming:
+        conf["streaming"] = True
+    if engine is not None:
+        conf["engine"] = engine
+
+    check_conf(conf, cat="method")
+    # output
+    if out is not None:
+        conf["src"] = path.basename(out)
+        with open(out, 'w') as fd:
+            json.dump(conf, fd, indent=2)
+    return conf
+
+
+def JSONify_methods(methods, out=None):
+    """Helper function to gather several methods in one configuration.
+
+    The methods are evaluated in the same workflow (one dataset, one
+    set of folds): a mapper loads and slices the data once for all the
+    methods and the reducers produce per-method summaries. The scripts
+    of the first method (by name) are used.
+
+    Parameters
+    ----------
+    methods : dict,
+        method configurations (see JSONify_estimator) by method name.
+    out : str, optional (default=None)
+        Filename to output the json.
+
+    Examples:
+    ---------
+    >>> conf = JSONify_methods({"logit": JSONify_estimator(logit),
+                                "svc": JSONify_estimator(svc)})
+    >>> grid = {"logit": make_log_grid(X, y), "svc": svc_grid}
+    """
+    scripts = ["mapper", "inner_reducer", "outer_reducer", "proposer"]
+    first = methods[sorted(methods)[0]]
+    conf = {}
+    conf["methods"] = {}
+    for name, m_cfg in methods.items():
+        conf["methods"][name] = dict((k, v) for k, v in m_cfg.items()
+                                     if k not in scripts + ["src"])
+    for k in scripts:
+        if k in first:
+            conf[k] = first[k]
 
     check_conf(conf, cat="method")
     # output
@@ -201,6 +288,7 @@ def JSONify_cv(cv, score_func,
                inner_score_func=None,
                inner_score_func_kwargs=None,
                stratified=False,
+               inner_search=None,
                out=None):
     """Helper function to create a cross-validation configuration
 
@@ -224,6 +312,13 @@ def JSONify_cv(cv, score_func,
         Keywords argument for inner_score_func.
     stratified : boolean, optional (default=False),
         Are the foldsIterators stratified.
+    inner_search : dict, optional (default=None, i.e. explicit grid),
+        Search strategy for the gridSearch (instead of an explicit grid):
+        {"strategy": "random" or "sequential",
+         "distributions": search space (see mempamal.search),
+         "budget": number of evaluated parameters per outer fold,
+         "n_per_round": parameters per round (sequential only),
+         "random_state": seed (optional)}
     out : str, optional (default=None)
         Filename to output the json.
 
@@ -307,6 +402,8 @@ def JSONify_cv(cv, score_func,
         conf["gridSearch"] = {}
         conf["gridSearch"]["foldsIterator"] = [icv_cl, icv_kwargs]
         conf["gridSearch"]["funcMetric"] = [isf, isf_kwargs]
+        if inner_search is not None:
+            conf["gridSearch"]["search"] = inner_search
 
     check_conf(conf, cat="crossval")
     # output
@@ -317,13 +414,124 @@ def JSONify_cv(cv, score_func,
     return conf
 
 
+def _precision_impact(X, X_enc, y, codec, folds, method_conf, cv_conf,
+                      grid=None, kernel=None):
+    """Score the first grid point on the first outer fold with the original
+    and the encoded features.
+
+    Note: internal function (see build_dataset)
+    """
+    train_index, test_index = get_fold(folds, 0)
+    name, method_conf = get_methods(method_conf)[0]
+    grid = method_grid(grid, name)
+    est_kwargs, est_param = construct_pipeline(method_conf)
+    which_cv = ("gridSearch" if cv_conf["modelSelection"]
+                else "crossval_score")
+    score_func, score_kwargs = get_score_func(cv_conf, cv=which_cv)
+    params = None if grid is None else grid[:1]
+    scores = []
+    for X_cur, c in ((X, None), (X_enc, codec)):
+        X_train, y_train, X_test, y_test = get_fold_data(
+            {"X": X_cur, "Y": y, "codec": c, "kernel": kernel},
+            train_index, test_index)
+        clf = GenericGridSearch(est=Pipeline,
+                                params=params,
+                                est_kwargs=est_kwargs,
+                                score_func=score_func,
+                                score_kwargs=score_kwargs)
+        clf.fit(X_train, y_train)
+        y_pred = clf.predict(X_test)
+        scores.append(clf.score(y_test, y_pred)[0])
+    return {"orig_score": scores[0], "score": scores[1],
+            "score_diff": np.asarray(scores[1]) - np.asarray(scores[0])}
+
+
 def build_dataset(X, y, method_conf, cv_conf,
                   outputdir=".",
                   grid=None,
                   verbose=False,
-                  compress=0):
+                  compress=0,
+                  dtype=None,
+                  compute_dtype=None,
+                  check_precision=False,
+                  fold_files=None,
+                  staging_dir=None,
+                  compact_folds=False,
+                  kernel=None,
+                  kernel_kwargs=None,
+                  stats=None,
+                  gram=False,
+                  store=None):
     """Write the dataset file.
+
+    Parameters
+    ----------
+    X : array, shape (n_samples, n_features)
+        features array
+    y : array, shape (n_samples, n_targets)
+        targets array
+    method_conf : dict,
+        configuration of the method.
+    cv_conf : dict,
+        configuration for cross-validation.
+    outputdir : str, optional (default=".")
+        directory for the dataset file.
+    grid : list of dict, optional (default=None)
+        grid of parameters. With a search strategy in cv_conf, the grid
+        of the first round is sampled if not provided. With several
+        methods (see JSONify_methods), a dict of grids by method name.
+    verbose : boolean, optional (default=False)
+        verbose mode.
+    compress : int, optional (default=0)
+        compression level for joblib.
+    dtype : str, optional (default=None, i.e. store X as given)
+        storage dtype for the features (e.g. "float32" or "int16" for a
+        quantization with scale/offset, see storage.encode_features).
+    compute_dtype : str, optional (default=None)
+        dtype of the features decoded by the mapper.
+    check_precision : boolean, optional (default=False)
+        with a dtype, also compare the score of the first grid point on the
+        first outer fold with the original and the encoded features.
+    fold_files : str in ["outer", "fold"], optional (default=None)
+        also materialize per-outer-fold (or per-fold) datasets so that each
+        job only reads the samples it needs (see storage.write_fold_files).
+    staging_dir : str, optional (default=None, i.e. outputdir)
+        directory for the fold files (e.g. the local copy of a remote
+        staging area).
+    compact_folds : boolean, optional (default=False)
+        encode the folds with bitmasks (see crossval.encode_folds) and
+        also write them (with the grid) in a small separate file
+        "folds.joblib" so the reducers can read them without loading X.
+    kernel : str, optional (default=None)
+        precompute the kernel matrix (e.g. "linear", see
+        storage.compute_kernel) and store it instead of X. The mappers
+        then feed K[train][:, train] and K[test][:, train] to estimators
+        with kernel="precomputed".
+    kernel_kwargs : dict, optional (default=None)
+        keywords arguments for the kernel.
+    stats : str in ["classification", "regression"], optional
+            (default=None)
+        precompute the sufficient statistics of all the samples and of
+        the samples removed by each fold (column sums, sums of squares
+        and per-class sums or X^T y) for the fold-aware steps (see
+        preprocessing.FoldStandardScaler and
+        preprocessing.FoldSelectKBest). The training statistics of each
+        fold are written in their own file (stats_<fold>.joblib, or in
+        the fold files) so that a job only loads its fold.
+    gram : boolean, optional (default=False)
+        with stats, also precompute the Gram matrices X^T X (of all the
+        samples and of the removed samples) so that the ridge engine
+        (see linear.RidgeGridSearch) downdates them instead of
+        factorizing X_train (for moderate numbers of features).
+    store : str, optional (default=None)
+        content-addressed store (a directory shared across experiments,
+        see storage.store_array): X and Y are written once under their
+        hash and the dataset file only holds references to them (see
+        storage.load_dataset). The fold files are not shared.
     """
+    if stats is not None and kernel is not None:
+        raise ValueError("Sufficient statistics require the features "
+                         "(not a precomputed kernel)")
     n_samples = X.shape[0]
     n_targets = 1 if (y.ndim == 1) else y.shape[1]
     if n_targets > 1:
@@ -331,13 +539,159 @@ def build_dataset(X, y, method_conf, cv_conf,
                       "may occur if your methods and/or metrics "
                       "cannot handle multiple targets.", RuntimeWarning)
     output_file = path.join(outputdir, "dataset.joblib")
+    search = get_search_conf(cv_conf)
+    if grid is None and search is not None:
+        grid = initial_grid(search)
     folds = dict(make_folds(y, cv_conf, verbose=verbose),
                  src=path.basename(output_file))
+    if compact_folds:
+        folds = dict(encode_folds(folds, n_samples),
+                     src=path.basename(output_file),
+                     index_src="folds.joblib")
+
+    # precomputed kernel mode (n_features >> n_samples)
+    if kernel is not None:
+        X = compute_kernel(X, kernel=kernel, kernel_kwargs=kernel_kwargs)
+        if verbose:
+            print("Precomputed {} kernel: {}".format(kernel, X.shape))
+
+    # reduced precision storage
+    X_enc, codec = encode_features(X, dtype=dtype,
+                                   compute_dtype=compute_dtype)
+    precision = None
+    if codec is not None:
+        precision = precision_report(X, X_enc, codec)
+        if check_precision:
+            precision.update(_precision_impact(X, X_enc, y, codec, folds,
+                                               method_conf, cv_conf, grid,
+                                               kernel=kernel))
+        if verbose:
+            print("Storage precision: {}".format(precision))
+
+    # sufficient statistics (of the features seen by the mappers)
+    fold_stats = None
+    if stats is not None:
+        fold_stats = compute_fold_stats(decode_features(X_enc, codec), y,
+                                        folds, target=stats, gram=gram)
 
     if verbose:
         print("Input dataset destination: {}".format(output_file))
-    dataset = {"X": X, "Y": y,
+    dataset = {"X": X_enc, "Y": y,
                "n_samples": n_samples, "n_targets": n_targets,
-               "folds": folds, "grid": grid}
-    joblib.dump(dataset, output_file, compress=compress)
+               "folds": folds, "grid": grid,
+               "codec": codec, "precision": precision,
+               "kernel": kernel, "stats": fold_stats}
+    if fold_files is not None:
+        staging = outputdir if staging_dir is None else staging_dir
+        folds["files"] = write_fold_files(dataset, level=fold_files,
+                                          staging_dir=staging,
+                                          compress=compress,
+                                          verbose=verbose)
+        folds["files"]["dir"] = staging_dir
+    if compact_folds:
+        joblib.dump({"folds": folds, "grid": grid,
+                     "n_samples": n_samples, "n_targets": n_targets},
+                    path.join(outputdir, folds["index_src"]),
+                    compress=compress)
+    # the dataset file only holds the index of the per-fold statistics
+    on_disk = dataset
+    if fold_stats is not None:
+        on_disk = dict(dataset, stats=write_fold_stats(fold_stats,
+                                                       outputdir=outputdir,
+                                                       compress=compress))
+    if store is not None:
+        # shared arrays, per-experiment metadata
+        # (arrays of Python objects stay in the dataset file)
+        joblib.dump(dict(on_disk,
+                         X=store_array(X_enc, store, relative_to=outputdir),
+                         Y=(y if y.dtype == object else
+                            store_array(y, store, relative_to=outputdir))),
+                    output_file, compress=compress)
+        if verbose:
+            print("X and Y stored in {}".format(store))
+    else:
+        joblib.dump(on_disk, output_file, compress=compress)
     return dataset
+
+
+def build_datasets(datasets, method_conf, cv_conf,
+                   outputdir=".",
+                   grid=None,
+                   verbose=False,
+                   compress=0,
+                   stats=None):
+    """Write a container file with many small datasets (e.g. one per
+    subject or per site).
+
+    Each dataset has its own folds (and statistics), the batched scripts
+    (multi_mapper.py and multi_inner_reducer.py) evaluate all the datasets
+    of a fold in-process and the outer reducer writes a per-dataset
+    summary table (see workflow.create_wf).
+
+    Parameters
+    ----------
+    datasets : dict,
+        the datasets, {name: (X, y)}.
+    method_conf : dict,
+        configuration of the method (a single method).
+    cv_conf : dict,
+        configuration for cross-validation (the same numbers of folds
+        for all the datasets).
+    outputdir : str, optional (default=".")
+        directory for the container file.
+    grid : list of dict, optional (default=None)
+        grid of parameters (shared by the datasets).
+    verbose : boolean, optional (default=False)
+        verbose mode.
+    compress : int, optional (default=0)
+        compression level for joblib.
+    stats : str in ["classification", "regression"], optional
+            (default=None)
+        precompute the sufficient statistics of each dataset (see
+        build_dataset).
+
+    Returns
+    -------
+    container : dict,
+        names (sorted), datasets by name, folds (numbers of folds and
+        source file) and grid.
+    """
+    if "methods" in method_conf:
+        raise ValueError("Several datasets support a single method")
+    if get_search_conf(cv_conf) is not None:
+        raise ValueError("Several datasets require the grid in advance "
+                         "(incompatible with sequential search)")
+    output_file = path.join(outputdir, "datasets.joblib")
+    names = sorted(datasets)
+    if not names:
+        raise ValueError("No dataset")
+    container = {"names": names, "datasets": {}, "grid": grid}
+    n_folds = None
+    for name in names:
+        X, y = datasets[name]
+        folds = make_folds(y, cv_conf, verbose=verbose)
+        cur_n_folds = (folds["n_outer"], folds.get("n_inner"))
+        if n_folds is None:
+            n_folds = cur_n_folds
+        elif cur_n_folds != n_folds:
+            raise ValueError("Dataset {} has {} outer and {} inner folds, "
+                             "expected {} and {}".format(name, cur_n_folds[0],
+                                                         cur_n_folds[1],
+                                                         *n_folds))
+        fold_stats = None
+        if stats is not None:
+            fold_stats = compute_fold_stats(X, y, folds, target=stats)
+        container["datasets"][name] = {
+            "X": X, "Y": y, "n_samples": X.shape[0],
+            "n_targets": 1 if (y.ndim == 1) else y.shape[1],
+            "folds": folds, "stats": fold_stats}
+    container["folds"] = {"n_outer": n_folds[0],
+                          "src": path.basename(output_file),
+                          "datasets": len(names)}
+    if n_folds[1] is not None:
+        container["folds"]["n_inner"] = n_folds[1]
+    if verbose:
+        print("{} datasets, destination: {}".format(len(names),
+                                                    output_file))
+    joblib.dump(container, output_file, compress=compress)
+    return container
@@ -86,9 +86,65 @@ def make_folds(y, cfg, verbose=False):
     return folds_dic
 
 
+def _pack_mask(index, n_samples):
+    """Bitmask (packed in uint8) of the samples of an index array.
+
+    """
+    mask = np.zeros(n_samples, dtype=np.uint8)
+    mask[index] = 1
+    return np.packbits(mask)
+
+
+def _unpack_mask(bits, n_samples):
+    """Sorted index array of the samples of a bitmask (see _pack_mask).
+
+    """
+    return np.flatnonzero(np.unpackbits(bits)[:n_samples])
+
+
+def encode_folds(folds, n_samples):
+    """Compact encoding of the folds dict (see make_folds) with bitmasks.
+
+    For each fold, the train and test samples are stored as bitmasks
+    (1 bit per sample) over all the samples (inner folds are not
+    relative to their outer training set anymore). get_fold decodes
+    them with sorted indices.
+
+    Parameters
+    ----------
+    folds : dict,
+        dictionnary with all the folds (see make_folds).
+    n_samples : int,
+        number of samples.
+    """
+    n_outer = folds["n_outer"]
+    n_inner = folds.get("n_inner", 0)
+    n_bytes = (n_samples + 7) // 8
+    enc = dict(encoding="bitmask", n_samples=n_samples, n_outer=n_outer,
+               outer_train=np.zeros((n_outer, n_bytes), dtype=np.uint8),
+               outer_test=np.zeros((n_outer, n_bytes), dtype=np.uint8))
+    if "n_inner" in folds:
+        enc["n_inner"] = n_inner
+        enc["inner_train"] = np.zeros((n_outer, n_inner, n_bytes),
+                                      dtype=np.uint8)
+        enc["inner_test"] = np.zeros((n_outer, n_inner, n_bytes),
+                                     dtype=np.uint8)
+    for i in range(n_outer):
+        train, test = get_fold(folds, i)
+        enc["outer_train"][i] = _pack_mask(train, n_samples)
+        enc["outer_test"][i] = _pack_mask(test, n_samples)
+        for k in range(n_inner):
+            train, test = get_fold(folds, i, inner=k)
+            enc["inner_train"][i, k] = _pack_mask(train, n_samples)
+            enc["inner_test"][i, k] = _pack_mask(test, n_samples)
+    return enc
+
+
 def get_fold(folds, outer, inner=None):
     """Get a given folds from the folds dict (see make_folds)
 
+    Support the compact encoding of the folds (see encode_folds).
+
     Parameters
     ----------
     folds : dict,
@@ -98,6 +154,17 @@ def get_fold(folds, outer, inner=None):
     inner : int, optional (default=None)
         ID of the inner fold.
     """
+    if folds.get("encoding") == "bitmask":
+        n_samples = folds["n_samples"]
+        if not (0 <= outer < folds["n_outer"] and
+                (inner is None or 0 <= inner < folds.get("n_inner", 0))):
+            raise KeyError("unexpected fold: outer={}, inner={}".format(
+                    outer, inner))
+        if inner is None:
+            return (_unpack_mask(folds["outer_train"][outer], n_samples),
+                    _unpack_mask(folds["outer_test"][outer], n_samples))
+        return (_unpack_mask(folds["inner_train"][outer, inner], n_samples),
+                _unpack_mask(folds["inner_test"][outer, inner], n_samples))
     try:
         if inner is None:
             return folds["%d" % outer]
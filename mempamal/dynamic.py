@@ -48,6 +48,38 @@ def construct_pipeline(cfg):
     return {'steps': pipe}, est_param
 
 
+def get_methods(cfg):
+    """List the (name, configuration) of the methods of a configuration.
+
+    A configuration with several methods (see
+    configuration.JSONify_methods) gives one item per method, a
+    configuration with a single method gives [(None, cfg)].
+
+    Parameters:
+    -----------
+    cfg : dict,
+        method configuration
+    """
+    if "methods" not in cfg:
+        return [(None, cfg)]
+    return [(name, cfg["methods"][name]) for name in sorted(cfg["methods"])]
+
+
+def method_grid(grid, name=None):
+    """Grid of parameters of a method.
+
+    Parameters:
+    -----------
+    grid : list of dict or dict,
+        grid of parameters, or grids by method name.
+    name : str, optional (default=None)
+        name of the method (see get_methods).
+    """
+    if name is not None and isinstance(grid, dict):
+        return grid.get(name)
+    return grid
+
+
 def get_score_func(cfg, cv="crossval_score"):
     """Import score function and kwargs from the CV configuration.
 
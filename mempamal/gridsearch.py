@@ -2,9 +2,196 @@
 #
 # License: BSD 3 clause
 """
-Simple GridSearch for a pipelined estimator (without warm restart).
+Simple GridSearch for a pipelined estimator (warm restart across folds
+only, see GenericGridSearch.fit).
 """
+import copy
+import os.path as path
+
 import numpy as np
+from sklearn.externals import joblib
+from sklearn.linear_model import (ElasticNet, LogisticRegression,
+                                  SGDClassifier, SGDRegressor)
+
+from mempamal.storage import atomic_dump
+
+# metrics with a vectorized scoring across grid parameters (see _batch_score)
+_CLASSIF_METRICS = ("f1_score", "precision_score", "recall_score")
+_REGRESS_METRICS = ("mean_squared_error", "mean_absolute_error", "r2_score")
+
+
+def _classif_batch_score(name, y_true, y_pred, average, pos_label=1):
+    """Vectorized f1/precision/recall for all the grid parameters.
+
+    Note: internal function (see _batch_score)
+    """
+    labels, enc = np.unique(np.concatenate((y_true, y_pred.ravel())),
+                            return_inverse=True)
+    n_params, n_samples = y_pred.shape
+    n_labels = labels.size
+    t = enc[:n_samples]
+    pred = enc[n_samples:].reshape((n_params, n_samples))
+    # (parameter, label) counts in one bincount
+    offset = (np.arange(n_params) * n_labels)[:, np.newaxis]
+    hit = (pred == t)
+    tp = np.bincount((pred + offset)[hit],
+                     minlength=n_params * n_labels).reshape((n_params, -1))
+    n_pred = np.bincount((pred + offset).ravel(),
+                         minlength=n_params * n_labels).reshape((n_params,
+                                                                 -1))
+    n_true = np.bincount(t, minlength=n_labels).astype(np.float64)
+    if average == "micro":
+        tp = tp.sum(axis=1)[:, np.newaxis]
+        n_pred = n_pred.sum(axis=1)[:, np.newaxis]
+        n_true = n_true.sum()[np.newaxis]
+    if name == "precision_score":
+        num, den = tp, n_pred
+    elif name == "recall_score":
+        num, den = tp, np.tile(n_true, (n_params, 1))
+    else:
+        num, den = 2 * tp, n_pred + n_true
+    # ill-defined scores are set to 0 (as sklearn does)
+    metric = num / np.maximum(den, 1).astype(np.float64)
+    if average == "micro":
+        return metric[:, 0]
+    elif average == "binary":
+        return metric[:, np.searchsorted(labels, pos_label)]
+    elif average == "weighted":
+        return np.dot(metric, n_true) / n_true.sum()
+    # macro: labels present in y_true or in the predictions of a parameter
+    present = (n_true > 0) | (n_pred > 0)
+    return (metric * present).sum(axis=1) / present.sum(axis=1)
+
+
+def _batch_score(score_func, score_kwargs, y_true, y_pred):
+    """Score the predictions of all the grid parameters in one pass.
+
+    Support common sklearn.metrics (accuracy, f1/precision/recall with an
+    explicit average, mean squared/absolute errors, r2) for one target.
+    Return None if the metric (or its keywords arguments) is not
+    supported and the generic loop must be used (e.g. binary targets
+    with a pos_label and an average other than "binary", whose score
+    depends on the sklearn version).
+
+    Parameters
+    ----------
+    score_func : func,
+        scoring function
+    score_kwargs : dict,
+        keywords arguments for the scoring function
+    y_true : array, shape (n_samples)
+        Real targets values
+    y_pred : array, shape (n_parameters, n_samples)
+        Targets prediction to score.
+    """
+    name = getattr(score_func, "__name__", None)
+    if (not getattr(score_func, "__module__", "").startswith(
+            "sklearn.metrics") or y_true.ndim != 1 or y_pred.ndim != 2):
+        return None
+    kwargs = dict(score_kwargs)
+    if name == "accuracy_score" and set(kwargs) <= set(["normalize"]):
+        hit = (y_pred == y_true)
+        if kwargs.get("normalize", True):
+            return np.mean(hit, axis=1)
+        return np.sum(hit, axis=1).astype(np.float64)
+    elif name in _CLASSIF_METRICS and "average" in kwargs:
+        average = kwargs.pop("average")
+        pos_label = kwargs.pop("pos_label", 1)
+        if kwargs or average not in ("binary", "micro", "macro",
+                                     "weighted"):
+            return None
+        if average == "binary":
+            labels = np.unique(np.concatenate((y_true, y_pred.ravel())))
+            if labels.size != 2 or pos_label not in labels:
+                return None
+        elif pos_label is not None:
+            # binary targets: before 0.18, sklearn scores the pos_label
+            # whatever the average, the generic loop keeps its behaviour
+            labels = np.unique(y_true)
+            if labels.size <= 2 and any(np.union1d(labels, p).size <= 2
+                                        for p in y_pred):
+                return None
+        return _classif_batch_score(name, y_true, y_pred, average,
+                                    pos_label=pos_label)
+    elif name in _REGRESS_METRICS and not kwargs:
+        err = y_pred - y_true
+        if name == "mean_squared_error":
+            return np.mean(err ** 2, axis=1)
+        elif name == "mean_absolute_error":
+            return np.mean(np.abs(err), axis=1)
+        ss_tot = np.sum((y_true - np.mean(y_true)) ** 2)
+        if ss_tot == 0:
+            return None
+        return 1. - np.sum(err ** 2, axis=1) / ss_tot
+    return None
+
+
+def warm_startable(est):
+    """Whether warm_start=True makes an estimator start from its current
+    coefficients when refitted: coordinate descent (ElasticNet, Lasso and
+    their multi-task variants), SGD and LogisticRegression. For the other
+    estimators (e.g. the ensembles, whose warm start only adds new
+    estimators) a refit with warm_start=True keeps the previous fit.
+
+    Parameters
+    ----------
+    est : estimator,
+        final step of a pipeline.
+    """
+    return (isinstance(est, (ElasticNet, LogisticRegression, SGDClassifier,
+                             SGDRegressor)) and
+            "warm_start" in est.get_params(deep=False))
+
+
+def _warm_estimator(est):
+    """Copy of a fitted pipeline whose final step starts from its current
+    solution when refitted (see warm_startable).
+
+    Parameters
+    ----------
+    est : estimator,
+        fitted pipelined estimator.
+    """
+    est = copy.deepcopy(est)
+    est.steps[-1][1].set_params(warm_start=True)
+    # the statistics of the previous fold must not be reused
+    for _, s_i in est.steps:
+        if hasattr(s_i, "set_fold_stats"):
+            s_i.set_fold_stats(None)
+    return est
+
+
+def _check_fold_stats(est, fold_stats):
+    """Check that the fold-aware steps of a pipeline hold the statistics
+    of the current fold (or none).
+
+    Note: internal function (see GenericGridSearch.fit)
+    """
+    fold = None if fold_stats is None else fold_stats.get("fold")
+    for name, s_i in est.steps:
+        stats = getattr(s_i, "_fold_stats", None)
+        if stats is not None and stats.get("fold") != fold:
+            raise ValueError("Step \'{}\' holds the statistics of fold {} "
+                             "instead of {}".format(name, stats.get("fold"),
+                                                    fold))
+
+
+def _load_checkpoint(checkpoint, signature):
+    """Scores (by grid index) of a checkpoint file with the same
+    signature (empty if none).
+
+    Note: internal function (see GenericGridSearch.fit_score)
+    """
+    if checkpoint is None or not path.exists(checkpoint):
+        return {}
+    try:
+        ckpt = joblib.load(checkpoint)
+    except Exception:
+        # unreadable checkpoint: start over
+        return {}
+    if ckpt.get("signature") != signature:
+        return {}
+    return ckpt["scores"]
 
 
 class GenericGridSearch(object):
@@ -15,7 +202,8 @@ class GenericGridSearch(object):
 
     def __init__(self, est, params, score_func,
                  est_kwargs=None,
-                 score_kwargs=None):
+                 score_kwargs=None,
+                 fold_stats=None):
         """
 
         Parameters
@@ -30,6 +218,10 @@ class GenericGridSearch(object):
             keywords arguments for the estimator
         score_kwargs : dict, optional (default=None)
             keywords arguments for the scoring function
+        fold_stats : dict, optional (default=None)
+            sufficient statistics of the training set (see
+            preprocessing.get_fold_stats) given to the leading
+            fold-aware steps of the pipeline.
         """
         if params is None:
             params = [None]
@@ -45,8 +237,9 @@ class GenericGridSearch(object):
             self.est_kwargs = est_kwargs
         else:
             self.est_kwargs = {}
+        self.fold_stats = fold_stats
 
-    def fit(self, X, y):
+    def fit(self, X, y, init=None):
         """Fit the estimator on each parameter of the grid.
 
         Parameters
@@ -55,22 +248,111 @@ class GenericGridSearch(object):
             features array
         y : array, shape (n_samples, n_targets)
             targets array
+        init : dict, optional (default=None)
+            fitted estimators by parameter (e.g. self.res of a
+            GenericGridSearch fitted on a neighbouring fold) to warm
+            start the estimators (see _warm_estimator), their fold-aware
+            steps get the statistics of this fold. The estimators that
+            cannot be warm started (see warm_startable) are refitted from
+            scratch.
         """
         for p in self.params:
-            param_kwargs = p if p is not None else {}
             p_ = tuple(p.values()) if p is not None else "None"
-            steps = self.est_kwargs['steps']
-            pipe_steps = []
-            for s in steps:
-                s_i = (s[1][0])()
-                for k, v in (s[1][1]).iteritems():
-                    s_i.__setattr__(k, v)
-                pipe_steps.append((s[0], s_i))
-
-            self.res[p_] = self.est(pipe_steps)
-            self.res[p_].set_params(**param_kwargs)
+            prev = None if init is None else init.get(p_)
+            if prev is None or not warm_startable(prev.steps[-1][1]):
+                self.res[p_] = self._make_estimator(p)
+            else:
+                self.res[p_] = _warm_estimator(prev)
+                self._set_fold_stats(self.res[p_])
+            _check_fold_stats(self.res[p_], self.fold_stats)
             self.res[p_].fit(X, y)
 
+    def _make_estimator(self, p):
+        """Instantiate the pipelined estimator for a parameter of the grid.
+
+        Parameters
+        ----------
+        p : dict or None,
+            parameter of the grid.
+        """
+        param_kwargs = p if p is not None else {}
+        steps = self.est_kwargs['steps']
+        pipe_steps = []
+        for s in steps:
+            s_i = (s[1][0])()
+            for k, v in (s[1][1]).iteritems():
+                s_i.__setattr__(k, v)
+            pipe_steps.append((s[0], s_i))
+        est = self.est(pipe_steps)
+        est.set_params(**param_kwargs)
+        self._set_fold_stats(est)
+        return est
+
+    def _set_fold_stats(self, est):
+        """Give the statistics of the fold to the leading fold-aware steps
+        of a pipeline (the others get none).
+
+        Parameters
+        ----------
+        est : estimator,
+            pipelined estimator.
+        """
+        # each fold-aware step gives the statistics of its output
+        stats = self.fold_stats
+        for _, s_i in est.steps:
+            if not hasattr(s_i, "set_fold_stats"):
+                stats = None
+            else:
+                stats = s_i.set_fold_stats(stats)
+
+    def fit_score(self, X_train, y_train, X_test, y_test, checkpoint=None,
+                  signature=None):
+        """Fit, predict and score each parameter of the grid in turn.
+
+        Streaming mode: the estimator of a parameter is released before
+        the next one is fitted, so the peak memory is one estimator
+        instead of one per parameter (self.res stays empty).
+
+        With a checkpoint file, the scores of the finished parameters
+        are (atomically) saved after each parameter, and a restarted job
+        with the same signature only evaluates the remaining ones.
+
+        Parameters
+        ----------
+        X_train : array, shape (n_train_samples, n_features)
+            training features array
+        y_train : array, shape (n_train_samples, n_targets)
+            training targets array
+        X_test : array, shape (n_test_samples, n_features)
+            testing features array
+        y_test : array, shape (n_test_samples, n_targets)
+            Real targets values
+        checkpoint : str, optional (default=None)
+            checkpoint file.
+        signature : str, optional (default=None)
+            signature of the job (e.g. its arguments), a checkpoint with
+            another signature (or grid) is ignored.
+
+        Returns
+        -------
+        scores : array, same layout as score
+        """
+        signature = (signature, repr(self.params))
+        done = _load_checkpoint(checkpoint, signature)
+        scores = []
+        for k, p in enumerate(self.params):
+            if k not in done:
+                est = self._make_estimator(p)
+                est.fit(X_train, y_train)
+                y_pred = est.predict(X_test)
+                del est
+                done[k] = self.score(y_test, y_pred[np.newaxis])[..., 0]
+                if checkpoint is not None:
+                    atomic_dump({"signature": signature, "scores": done},
+                                checkpoint)
+            scores.append(done[k])
+        return np.asarray(scores).T
+
     def predict(self, X):
         """Predict the targets from X for each parameter of the grid
 
@@ -95,6 +377,13 @@ class GenericGridSearch(object):
         y_pred : array, shape (n_parameters, n_samples, n_targets)
             Targets prediction to score.
         """
+        y_test = np.asarray(y_test)
+        y_pred = np.asarray(y_pred)
+        scores = _batch_score(self.score_func, self.score_kwargs,
+                              y_test, y_pred)
+        if scores is not None:
+            return scores
+        # generic loop for arbitrary scoring functions
         scores = []
         for yp in y_pred:
             scores.append(self.score_func(y_test, yp, **self.score_kwargs))
@@ -0,0 +1,220 @@
+# Author: Benoit Da Mota <damota.benoit@gmail.com>
+#
+# License: BSD 3 clause
+"""
+Closed-form grid search for ridge models.
+
+One factorization per fold (an SVD of the training features, or an
+eigendecomposition of the Gram matrix downdated from the global one, see
+preprocessing.compute_fold_stats) gives the solutions for all the values
+of alpha at the cost of a matrix product each.
+"""
+import numpy as np
+from sklearn.linear_model import Ridge, RidgeClassifier
+from sklearn.preprocessing import LabelBinarizer
+
+from mempamal.gridsearch import GenericGridSearch
+
+# grid search engines (see get_engine)
+ENGINES = ("generic", "ridge")
+
+
+def get_engine(cfg):
+    """Grid search class of a method configuration.
+
+    Parameters
+    ----------
+    cfg : dict,
+        method configuration (see configuration.JSONify_estimator).
+    """
+    engine = cfg.get("engine", "generic")
+    if engine == "ridge":
+        return RidgeGridSearch
+    elif engine == "generic":
+        return GenericGridSearch
+    raise ValueError("Unknown grid search engine \'{}\'".format(engine))
+
+
+def _ridge_factors(Xc, Yc):
+    """Factors of the ridge solutions from centered data (SVD).
+
+    coef(alpha) = V (A / (w + alpha)) with V the right singular vectors,
+    w the squared singular values and A = diag(s) U^T Yc.
+
+    Note: internal function (see RidgeGridSearch)
+    """
+    U, s, Vt = np.linalg.svd(Xc, full_matrices=False)
+    return Vt.T, s ** 2, s[:, np.newaxis] * np.dot(U.T, Yc)
+
+
+def _ridge_factors_gram(gram, XtY):
+    """Factors of the ridge solutions from the centered Gram matrix and
+    cross-products (eigendecomposition, see _ridge_factors).
+
+    Note: internal function (see RidgeGridSearch)
+    """
+    w, V = np.linalg.eigh(gram)
+    return V, np.maximum(w, 0.), np.dot(V.T, XtY)
+
+
+class RidgeGridSearch(GenericGridSearch):
+    """Closed-form grid search of the alpha of a ridge final step
+    (sklearn.linear_model.Ridge or RidgeClassifier).
+
+    The preceding steps of the pipeline are fitted once. Same interface
+    and scores layout as GenericGridSearch, which is used instead if the
+    grid sets other parameters or if the final step is not supported.
+    """
+
+    def _alphas(self, est=None):
+        """Values of alpha of the grid (None if not supported).
+
+        """
+        if est is None:
+            est = self._make_estimator(self.params[0])
+        final_name, final = est.steps[-1]
+        params = final.get_params(deep=False)
+        if (not isinstance(final, (Ridge, RidgeClassifier)) or
+                params.get("normalize", False) or
+                params.get("class_weight") is not None):
+            return None
+        key = "{}__alpha".format(final_name)
+        if self.params == [None]:
+            return [final.alpha]
+        if any(p.keys() != [key] for p in self.params):
+            return None
+        return [p[key] for p in self.params]
+
+    def fit(self, X, y, init=None):
+        """Fit the ridge solutions of all the grid parameters.
+
+        Parameters
+        ----------
+        X : array, shape (n_samples, n_features)
+            features array
+        y : array, shape (n_samples, n_targets)
+            targets array
+        init : dict, optional (default=None)
+            ignored by the closed-form solutions (see
+            GenericGridSearch.fit).
+        """
+        est = self._make_estimator(self.params[0])
+        final = est.steps[-1][1]
+        alphas = self._alphas(est)
+        self._ridge = None
+        if alphas is None:
+            return super(RidgeGridSearch, self).fit(X, y, init=init)
+
+        # preprocessing steps (and statistics of their output)
+        stats = self.fold_stats
+        Xt = X
+        for _, s_i in est.steps[:-1]:
+            if stats is not None and hasattr(s_i, "set_fold_stats"):
+                stats = s_i.set_fold_stats(stats)
+            else:
+                stats = None
+            Xt = s_i.fit_transform(Xt, y)
+
+        # targets (+1/-1 encoding for the classifier)
+        classes = None
+        Y = np.asarray(y)
+        if isinstance(final, RidgeClassifier):
+            lb = LabelBinarizer(pos_label=1, neg_label=-1)
+            Y = lb.fit_transform(Y)
+            classes = lb.classes_
+        Y = Y.reshape((Xt.shape[0], -1)).astype(np.float64)
+
+        if (stats is not None and "gram" in stats and
+                stats["n"] == Xt.shape[0]):
+            # downdated Gram matrix (n_features x n_features)
+            n = float(stats["n"])
+            if classes is None:
+                y_sum, XtY = stats["y_sum"], stats["Xty"]
+            else:
+                present = stats["class_count"] > 0
+                count = stats["class_count"][present]
+                y_sum = 2 * count - n
+                XtY = (2 * stats["class_sum"][present] - stats["sum"]).T
+                if count.size == 2:
+                    y_sum, XtY = y_sum[1:], XtY[:, 1:]
+            # statistics of the shifted features Z = X - shift
+            shift = stats.get("shift", np.zeros_like(stats["sum"]))
+            z_mean, y_mean = stats["sum"] / n, y_sum / n
+            gram = stats["gram"]
+            if final.fit_intercept:
+                # centered (shift invariant)
+                gram = gram - n * np.outer(z_mean, z_mean)
+                XtY = XtY - n * np.outer(z_mean, y_mean)
+                x_mean = shift + z_mean
+            else:
+                cross = np.outer(shift, stats["sum"])
+                gram = gram + cross + cross.T + n * np.outer(shift, shift)
+                XtY = XtY + np.outer(shift, y_sum)
+                x_mean = np.zeros_like(z_mean)
+                y_mean = np.zeros_like(y_mean)
+            V, w, A = _ridge_factors_gram(gram, XtY)
+        else:
+            Xt = np.asarray(Xt, dtype=np.float64)
+            x_mean = np.zeros(Xt.shape[1])
+            y_mean = np.zeros(Y.shape[1])
+            if final.fit_intercept:
+                x_mean = Xt.mean(axis=0)
+                y_mean = Y.mean(axis=0)
+            V, w, A = _ridge_factors(Xt - x_mean, Y - y_mean)
+        self._ridge = {"steps": est.steps[:-1], "alphas": alphas,
+                       "V": V, "w": w, "A": A,
+                       "x_mean": x_mean, "y_mean": y_mean,
+                       "classes": classes, "ravel": np.ndim(y) == 1}
+        return self
+
+    def coef(self, alpha):
+        """Coefficients of the ridge solution for a value of alpha.
+
+        Parameters
+        ----------
+        alpha : float,
+            regularization parameter.
+        """
+        r = self._ridge
+        return np.dot(r["V"], r["A"] / (r["w"] + alpha)[:, np.newaxis])
+
+    def predict(self, X):
+        """Predict the targets from X for each parameter of the grid
+
+        Parameters
+        ----------
+        X : array, shape (n_samples, n_features)
+            features array
+        """
+        r = self._ridge
+        if r is None:
+            return super(RidgeGridSearch, self).predict(X)
+        for _, s_i in r["steps"]:
+            X = s_i.transform(X)
+        B = np.dot(X - r["x_mean"], r["V"])
+        y_pred = []
+        for alpha in r["alphas"]:
+            dec = (np.dot(B, r["A"] / (r["w"] + alpha)[:, np.newaxis]) +
+                   r["y_mean"])
+            if r["classes"] is not None:
+                idx = ((dec[:, 0] > 0).astype(int) if dec.shape[1] == 1
+                       else np.argmax(dec, axis=1))
+                y_pred.append(r["classes"][idx])
+            else:
+                y_pred.append(dec.ravel() if r["ravel"] else dec)
+        return np.asarray(y_pred)
+
+    def fit_score(self, X_train, y_train, X_test, y_test, checkpoint=None,
+                  signature=None):
+        """Fit, predict and score each parameter of the grid.
+
+        The closed-form solutions share one factorization, so the
+        streaming mode (see GenericGridSearch.fit_score) is simply
+        fit/predict/score (without checkpoint).
+        """
+        if self._alphas() is None:
+            return super(RidgeGridSearch, self).fit_score(
+                X_train, y_train, X_test, y_test, checkpoint=checkpoint,
+                signature=signature)
+        self.fit(X_train, y_train)
+        return self.score(y_test, self.predict(X_test))
@@ -0,0 +1,390 @@
+# Author: Benoit Da Mota <damota.benoit@gmail.com>
+#
+# License: BSD 3 clause
+"""
+Fold-aware preprocessing steps (statistics downdated from global sums).
+
+build_dataset computes the sufficient statistics of all the samples and
+of the samples removed by each fold (the complement of its training
+set). The statistics of a training set are then obtained by subtraction
+in O(n_removed * n_features) instead of O(n_train * n_features), stored
+in one small file per fold and given to the fold-aware steps of the
+pipeline (see GenericGridSearch.fold_stats).
+"""
+import os.path as path
+
+import numpy as np
+import sklearn.externals.joblib as joblib
+from sklearn.feature_selection import SelectKBest
+from sklearn.feature_selection import f_classif, f_regression
+from sklearn.preprocessing import StandardScaler
+
+from mempamal.crossval import get_fold
+
+_UNIVARIATE = {"f_classif": f_classif, "f_regression": f_regression}
+
+
+def sufficient_stats(X, y=None, target="classification", classes=None,
+                     gram=False, shift=None):
+    """Sufficient statistics of some samples.
+
+    The features are shifted (X - shift) before accumulation to avoid
+    the cancellation of sumsq / n - mean ** 2 for features with a large
+    offset.
+
+    Parameters
+    ----------
+    X : array, shape (n_samples, n_features)
+        features array
+    y : array, shape (n_samples[, n_targets]), optional (default=None)
+        targets array
+    target : str in ["classification", "regression"],
+             optional (default="classification")
+        per-class sums (classification) or cross-products X^T y
+        (regression).
+    classes : array, optional (default=None, i.e. classes of y)
+        classes of the whole dataset (to align the per-class sums).
+    gram : boolean, optional (default=False)
+        also compute the Gram matrix X^T X (see linear.RidgeGridSearch).
+    shift : array, shape (n_features), optional (default=None, i.e. 0)
+        shift of the features (e.g. the mean of the whole dataset).
+
+    Returns
+    -------
+    stats : dict,
+        n, shift, sum and sumsq (column sums and sums of squares), gram
+        and either classes, class_count and class_sum or y_sum, y_sumsq
+        and Xty, all of the shifted features.
+    """
+    X = np.asarray(X, dtype=np.float64)
+    shift = np.zeros(X.shape[1]) if shift is None else shift
+    X = X - shift
+    stats = {"n": X.shape[0], "shift": shift,
+             "sum": X.sum(axis=0),
+             "sumsq": np.einsum("ij,ij->j", X, X)}
+    if gram:
+        stats["gram"] = np.dot(X.T, X)
+    if y is None:
+        return stats
+    if target == "classification":
+        classes = np.unique(y) if classes is None else classes
+        onehot = (np.asarray(y).ravel()[:, np.newaxis] ==
+                  classes).astype(np.float64)
+        stats["classes"] = classes
+        stats["class_count"] = onehot.sum(axis=0)
+        stats["class_sum"] = np.dot(onehot.T, X)
+    elif target == "regression":
+        Y = np.asarray(y, dtype=np.float64).reshape((X.shape[0], -1))
+        stats["y_sum"] = Y.sum(axis=0)
+        stats["y_sumsq"] = (Y ** 2).sum(axis=0)
+        stats["Xty"] = np.dot(X.T, Y)
+    else:
+        raise ValueError("Unknown statistics target \'{}\'".format(target))
+    return stats
+
+
+def compute_fold_stats(X, y, folds, target="classification", gram=False):
+    """Global statistics and statistics of the removed samples of each fold.
+
+    Parameters
+    ----------
+    X : array, shape (n_samples, n_features)
+        features array
+    y : array, shape (n_samples[, n_targets])
+        targets array
+    folds : dict,
+        the folds (see crossval.make_folds).
+    target : str in ["classification", "regression"],
+             optional (default="classification")
+        kind of statistics (see sufficient_stats).
+    gram : boolean, optional (default=False)
+        also compute the Gram matrices (n_features x n_features).
+    """
+    n_samples = X.shape[0]
+    classes = np.unique(y) if target == "classification" else None
+    # shift of all the statistics: the mean of the whole dataset
+    shift = np.asarray(X, dtype=np.float64).mean(axis=0)
+    res = {"target": target,
+           "global": sufficient_stats(X, y, target, classes, gram, shift),
+           "removed": {}}
+    n_inner = folds.get("n_inner", 0)
+    for i in range(folds["n_outer"]):
+        for k in [None] + range(n_inner):
+            train, _ = get_fold(folds, i, inner=k)
+            removed = np.setdiff1d(np.arange(n_samples), train)
+            key = "%d" % i if k is None else "%d_%d" % (i, k)
+            res["removed"][key] = sufficient_stats(X[removed], y[removed],
+                                                   target, classes, gram,
+                                                   shift)
+    return res
+
+
+def train_stats(fold_stats, key):
+    """Sufficient statistics of the training set of a fold, downdated
+    from the global statistics (or None).
+
+    Parameters
+    ----------
+    fold_stats : dict,
+        global statistics and statistics of the removed samples (see
+        compute_fold_stats).
+    key : str,
+        fold key (e.g. "0" or "0_1").
+    """
+    removed = fold_stats["removed"].get(key)
+    if removed is None:
+        return None
+    stats = dict((k, v if k in ("classes", "shift") else v - removed[k])
+                 for k, v in fold_stats["global"].iteritems())
+    # fold identity (see gridsearch._check_fold_stats)
+    stats["fold"] = key
+    return stats
+
+
+def write_fold_stats(fold_stats, outputdir=".", compress=0):
+    """Write the training statistics of each fold in its own file, so a
+    job only loads the statistics of its fold.
+
+    Parameters
+    ----------
+    fold_stats : dict,
+        statistics of the folds (see compute_fold_stats).
+    outputdir : str, optional (default=".")
+        directory of the files (the directory of the dataset file).
+    compress : int, optional (default=0)
+        compression level for joblib.
+
+    Returns
+    -------
+    index : dict,
+        target and file names by fold key (see get_fold_stats).
+    """
+    index = {"target": fold_stats["target"], "files": {}}
+    for key in fold_stats["removed"]:
+        fname = "stats_{}.joblib".format(key)
+        joblib.dump(train_stats(fold_stats, key),
+                    path.join(outputdir, fname), compress=compress)
+        index["files"][key] = fname
+    return index
+
+
+def get_fold_stats(dataset, outer, inner=None, columns=None, base_dir="."):
+    """Sufficient statistics of the training set of a fold (or None).
+
+    The statistics of a dataset are either all the statistics (see
+    compute_fold_stats), per-fold files (see write_fold_stats) or the
+    training statistics of some folds (fold files, see
+    storage.write_fold_files).
+
+    Parameters
+    ----------
+    dataset : dict,
+        the dataset (see configuration.build_dataset).
+    outer : int,
+        outer fold ID.
+    inner : int, optional (default=None)
+        inner fold ID.
+    columns : slice, optional (default=None, i.e. all the features)
+        columns of a feature block (see storage.block_columns).
+    base_dir : str, optional (default=".")
+        directory of the per-fold files (the directory of the dataset
+        file).
+    """
+    stats = dataset.get("stats")
+    if stats is None:
+        return None
+    key = "%d" % outer if inner is None else "%d_%d" % (outer, inner)
+    if "folds" in stats:
+        stats = stats["folds"].get(key)
+    elif "files" in stats:
+        fname = stats["files"].get(key)
+        stats = (None if fname is None
+                 else joblib.load(path.join(base_dir, fname)))
+    else:
+        stats = train_stats(stats, key)
+    if stats is None:
+        return None
+    if columns is not None:
+        stats = dict(stats)
+        # statistics of a feature block
+        for k in ("shift", "sum", "sumsq", "Xty"):
+            if k in stats:
+                stats[k] = stats[k][columns]
+        if "class_sum" in stats:
+            stats["class_sum"] = stats["class_sum"][:, columns]
+        if "gram" in stats:
+            stats["gram"] = stats["gram"][columns, columns]
+    return stats
+
+
+def _mean_var_scale(stats):
+    """Mean, variance and scale of the columns from sufficient statistics.
+
+    Note: internal function (see FoldStandardScaler)
+    """
+    n = float(stats["n"])
+    # mean of the shifted features (small for a good shift)
+    mean = stats["sum"] / n
+    var = np.maximum(stats["sumsq"] / n - mean ** 2, 0.)
+    scale = np.sqrt(var)
+    scale[scale == 0.] = 1.
+    return stats.get("shift", 0.) + mean, var, scale
+
+
+class FoldStandardScaler(StandardScaler):
+    """StandardScaler fitted from the (downdated) statistics of the fold.
+
+    Falls back to sklearn.preprocessing.StandardScaler.fit without
+    statistics (or if they do not match the training set).
+    """
+
+    def set_fold_stats(self, stats):
+        """Set the statistics of the training set.
+
+        Parameters
+        ----------
+        stats : dict or None,
+            statistics of the training set (see get_fold_stats), None
+            to fit from the data.
+
+        Returns
+        -------
+        stats : dict or None,
+            statistics of the transformed training set.
+        """
+        self._fold_stats = stats
+        if stats is None:
+            return None
+        mean, _, scale = _mean_var_scale(stats)
+        if not self.with_mean:
+            mean = np.zeros_like(mean)
+        if not self.with_std:
+            scale = np.ones_like(scale)
+        # (X - mean) / scale = Z / scale + (shift - mean) / scale with
+        # Z the shifted features: only the shift and the scale change
+        out = dict(stats)
+        out["shift"] = (stats.get("shift", 0.) - mean) / scale
+        out["sum"] = stats["sum"] / scale
+        out["sumsq"] = stats["sumsq"] / scale ** 2
+        if "gram" in stats:
+            out["gram"] = stats["gram"] / np.outer(scale, scale)
+        if "class_sum" in stats:
+            out["class_sum"] = stats["class_sum"] / scale
+        if "Xty" in stats:
+            out["Xty"] = stats["Xty"] / scale[:, np.newaxis]
+        return out
+
+    def fit(self, X, y=None):
+        """Compute the mean and std (from the statistics if available).
+
+        Parameters
+        ----------
+        X : array, shape (n_samples, n_features)
+            training features array
+        """
+        stats = getattr(self, "_fold_stats", None)
+        if stats is None or stats["n"] != X.shape[0]:
+            return super(FoldStandardScaler, self).fit(X, y)
+        self.mean_, self.var_, self.scale_ = _mean_var_scale(stats)
+        self.n_samples_seen_ = stats["n"]
+        if not self.with_std:
+            self.var_ = None
+            self.scale_ = None
+        if not (self.with_mean or self.with_std):
+            self.mean_ = None
+        # sklearn < 0.17 transforms with std_ (a read-only deprecated
+        # property in 0.17-0.18)
+        if not isinstance(getattr(type(self), "std_", None), property):
+            self.std_ = self.scale_
+        return self
+
+
+class FoldSelectKBest(SelectKBest):
+    """SelectKBest with F-scores computed from the (downdated) statistics
+    of the fold.
+
+    The scoring function is a name ("f_classif" or "f_regression") so
+    that the step can be stored in a JSON configuration. Falls back to
+    the scoring function without statistics (or if they do not match
+    the training set).
+    """
+
+    def __init__(self, score_func="f_classif", k=10):
+        super(FoldSelectKBest, self).__init__(score_func=score_func, k=k)
+
+    def set_fold_stats(self, stats):
+        """Set the statistics of the training set.
+
+        Parameters
+        ----------
+        stats : dict or None,
+            statistics of the training set (see get_fold_stats), None
+            to fit from the data.
+
+        Returns
+        -------
+        None (unknown statistics of the selected features)
+        """
+        self._fold_stats = stats
+        return None
+
+    def fit(self, X, y):
+        """Compute the F-scores (from the statistics if available).
+
+        Parameters
+        ----------
+        X : array, shape (n_samples, n_features)
+            training features array
+        y : array, shape (n_samples)
+            training targets array
+        """
+        stats = getattr(self, "_fold_stats", None)
+        key = ("class_sum" if self.score_func == "f_classif" else "Xty")
+        if (stats is None or stats["n"] != X.shape[0] or key not in stats or
+                (key == "Xty" and stats["Xty"].shape[1] != 1)):
+            self.scores_, self.pvalues_ = _UNIVARIATE[self.score_func](X, y)
+        elif key == "class_sum":
+            self.scores_, self.pvalues_ = _f_classif_stats(stats)
+        else:
+            self.scores_, self.pvalues_ = _f_regression_stats(stats)
+        return self
+
+
+def _f_classif_stats(stats):
+    """ANOVA F-value from sufficient statistics (see f_classif).
+
+    Note: internal function (see FoldSelectKBest)
+    """
+    from scipy.stats import f as f_dist
+    n = float(stats["n"])
+    present = stats["class_count"] > 0
+    count = stats["class_count"][present]
+    class_sum = stats["class_sum"][present]
+    sq_sum = stats["sum"] ** 2 / n
+    ss_tot = stats["sumsq"] - sq_sum
+    ss_bn = np.sum(class_sum ** 2 / count[:, np.newaxis], axis=0) - sq_sum
+    ss_wn = ss_tot - ss_bn
+    df_bn = count.size - 1
+    df_wn = n - count.size
+    with np.errstate(divide="ignore", invalid="ignore"):
+        f = (ss_bn / df_bn) / (ss_wn / df_wn)
+    return f, f_dist.sf(f, df_bn, df_wn)
+
+
+def _f_regression_stats(stats):
+    """Univariate linear regression F-value from sufficient statistics
+    (see f_regression, centered).
+
+    Note: internal function (see FoldSelectKBest)
+    """
+    from scipy.stats import f as f_dist
+    n = float(stats["n"])
+    x_mean = stats["sum"] / n
+    y_mean = stats["y_sum"][0] / n
+    cov = stats["Xty"][:, 0] - n * x_mean * y_mean
+    x_ss = stats["sumsq"] - n * x_mean ** 2
+    y_ss = stats["y_sumsq"][0] - n * y_mean ** 2
+    with np.errstate(divide="ignore", invalid="ignore"):
+        corr = cov / np.sqrt(x_ss * y_ss)
+        f = corr ** 2 / (1 - corr ** 2) * (n - 2)
+    return f, f_dist.sf(f, 1, n - 2)
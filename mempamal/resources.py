@@ -0,0 +1,200 @@
+# Author: Benoit Da Mota <damota.benoit@gmail.com>
+#
+# License: BSD 3 clause
+"""
+Functions relative to the resources (memory and threads) of the jobs.
+"""
+import resource
+import sys
+from glob import glob
+
+import numpy as np
+from sklearn.externals import joblib
+
+# default memory model of a job (see estimate_memory)
+_BASE_RSS = 150 * 2 ** 20
+_FOLD_RATIO = 3.
+_MARGIN = 1.2
+
+
+def peak_rss():
+    """Peak resident set size of the current process (in bytes).
+
+    """
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on OSX and in kilobytes on Linux
+    return rss if sys.platform == "darwin" else rss * 1024
+
+
+def memory_info(script, dataset=None, X_train=None, X_test=None):
+    """Memory record of a job, stored with its results.
+
+    Parameters
+    ----------
+    script : str,
+        kind of job (e.g. "mapper", "inner_reducer").
+    dataset : dict, optional (default=None)
+        the dataset loaded by the job.
+    X_train : array, optional (default=None)
+        training features.
+    X_test : array, optional (default=None)
+        testing features.
+    """
+    info = {"script": script, "peak_rss": peak_rss()}
+    if dataset is not None:
+        info["dataset_nbytes"] = dataset_nbytes(dataset)
+    if X_train is not None:
+        info["X_train_nbytes"] = X_train.nbytes
+    if X_test is not None:
+        info["X_test_nbytes"] = X_test.nbytes
+    return info
+
+
+def dataset_nbytes(dataset):
+    """Size in bytes of the arrays of a dataset.
+
+    Parameters
+    ----------
+    dataset : dict,
+        the dataset (see configuration.build_dataset).
+    """
+    return sum(v.nbytes for v in dataset.values()
+               if isinstance(v, np.ndarray))
+
+
+def load_memory_history(file_pattern, verbose=False):
+    """Read the memory records of past runs.
+
+    Parameters
+    ----------
+    file_pattern : str,
+        glob pattern of the results files (e.g. "./results/*.pkl").
+    verbose : boolean, optional (default=False)
+        verbose mode.
+    """
+    history = []
+    for cur_file in glob(file_pattern):
+        try:
+            cur_ar = joblib.load(cur_file)
+        except Exception:
+            continue
+        if isinstance(cur_ar, dict) and "memory" in cur_ar:
+            if verbose:
+                print("Memory record in {}".format(cur_file))
+            history.append(cur_ar["memory"])
+    return history
+
+
+def memory_spec(dataset, node_memory=None, history=None):
+    """Build the memory specification of a workflow (see create_wf).
+
+    Parameters
+    ----------
+    dataset : dict,
+        the dataset (see configuration.build_dataset).
+    node_memory : int, optional (default=None)
+        memory of a node (in MB) to pack the jobs.
+    history : str or list, optional (default=None)
+        memory records of past runs or a glob pattern to read them.
+    """
+    X = dataset["X"]
+    codec = dataset.get("codec")
+    dtype = X.dtype if codec is None else np.dtype(codec["compute_dtype"])
+    if isinstance(history, str):
+        history = load_memory_history(history)
+    return {"n_features": X.shape[1],
+            "itemsize": dtype.itemsize,
+            "dataset_nbytes": dataset_nbytes(dataset),
+            "node_memory": node_memory,
+            "history": history}
+
+
+def estimate_memory(spec, script, n_samples):
+    """Estimate the memory (in MB) required by a job.
+
+    The model is: peak = base + dataset + ratio * fold data, where the
+    ratio is learned from the history of the same kind of job
+    (default: 3).
+
+    Parameters
+    ----------
+    spec : dict,
+        memory specification (see memory_spec).
+    script : str,
+        kind of job (e.g. "mapper", "inner_reducer").
+    n_samples : int,
+        number of samples (train + test) handled by the job.
+    """
+    fold_nbytes = n_samples * spec["n_features"] * spec["itemsize"]
+    ratio = _FOLD_RATIO
+    records = [h for h in (spec["history"] or [])
+               if h.get("script") == script and "X_train_nbytes" in h]
+    if records:
+        ratio = max(max((h["peak_rss"] - _BASE_RSS - h["dataset_nbytes"]) /
+                        float(h["X_train_nbytes"] + h["X_test_nbytes"])
+                        for h in records), 1.)
+    peak = _BASE_RSS + spec["dataset_nbytes"] + ratio * fold_nbytes
+    return int(np.ceil(_MARGIN * peak / 2 ** 20))
+
+
+def pack_jobs(memory, node_memory):
+    """Pack jobs onto nodes without oversubscribing their memory.
+
+    First-fit decreasing bin packing.
+
+    Parameters
+    ----------
+    memory : dict,
+        memory (in MB) required by each job name.
+    node_memory : int,
+        memory of a node (in MB).
+
+    Returns
+    -------
+    nodes : dict,
+        node index for each job name.
+    """
+    nodes = {}
+    free = []
+    for name in sorted(memory, key=lambda n: memory[n], reverse=True):
+        if memory[name] > node_memory:
+            raise ValueError("Job \'{}\' requires {}MB, more than a node "
+                             "({}MB)".format(name, memory[name], node_memory))
+        for k, f in enumerate(free):
+            if memory[name] <= f:
+                free[k] -= memory[name]
+                nodes[name] = k
+                break
+        else:
+            free.append(node_memory - memory[name])
+            nodes[name] = len(free) - 1
+    return nodes
+
+
+def thread_budget(node_cores, procs_per_node):
+    """Number of threads per job to avoid oversubscribing a node.
+
+    Parameters
+    ----------
+    node_cores : int,
+        number of cores of a node.
+    procs_per_node : int,
+        number of simultaneous jobs on a node.
+    """
+    return max(1, int(node_cores) // max(1, int(procs_per_node)))
+
+
+def thread_env(n_threads):
+    """Environment variables limiting the BLAS/OpenMP threads of a job.
+
+    Parameters
+    ----------
+    n_threads : int,
+        number of threads of the job.
+    """
+    n = str(int(n_threads))
+    return {"OMP_NUM_THREADS": n,
+            "MKL_NUM_THREADS": n,
+            "OPENBLAS_NUM_THREADS": n,
+            "VECLIB_MAXIMUM_THREADS": n,
+            "NUMEXPR_NUM_THREADS": n}
@@ -0,0 +1,342 @@
+# Author: Benoit Da Mota <damota.benoit@gmail.com>
+#
+# License: BSD 3 clause
+"""
+Simple local runner for a workflow (timeouts and speculative duplicates).
+"""
+import json
+import multiprocessing
+import os
+import subprocess
+import time
+
+import numpy as np
+
+from mempamal.resources import thread_budget, thread_env
+
+
+def _kill(proc):
+    """Kill a process (if still running) and wait for it.
+
+    """
+    if proc.poll() is None:
+        proc.kill()
+    proc.wait()
+
+
+def _graph(cmd, dep):
+    """Predecessors, successors and groups of siblings (jobs with the same
+    successors, e.g. the inner folds of an outer fold) of a workflow.
+
+    """
+    preds = dict((name, set()) for name in cmd)
+    succs = dict((name, set()) for name in cmd)
+    for a, b in dep:
+        preds[b].add(a)
+        succs[a].add(b)
+    groups = {}
+    for name in cmd:
+        groups.setdefault(frozenset(succs[name]), []).append(name)
+    siblings = dict((name, groups[frozenset(succs[name])]) for name in cmd)
+    return preds, siblings
+
+
+def progress(status, meta, preds, start):
+    """Progress metrics of a running workflow.
+
+    Parameters
+    ----------
+    status : dict,
+        current status of each job.
+    meta : dict,
+        metadata of the jobs (see create_wf).
+    preds : dict,
+        predecessors of each job.
+    start : float,
+        start time of the workflow.
+
+    Returns
+    -------
+    metrics : dict,
+        elapsed time, jobs per second, queue depth (waiting jobs with
+        all their predecessors done), ETA (in seconds, None before the
+        first finished job) and job counts by stage and state.
+    """
+    elapsed = time.time() - start
+    finished = sum(1 for state in status.itervalues()
+                   if state in ("done", "failed", "skipped"))
+    stages = {}
+    for name, state in status.iteritems():
+        stage = meta.get(name, {}).get("stage", "unknown")
+        counts = stages.setdefault(stage, {})
+        counts[state] = counts.get(state, 0) + 1
+    queue = sum(1 for name, state in status.iteritems()
+                if state == "waiting" and
+                all(status[p] == "done" for p in preds[name]))
+    rate = finished / elapsed if elapsed > 0 else 0.
+    remaining = len(status) - finished
+    return {"time": time.time(),
+            "elapsed": elapsed,
+            "n_jobs": len(status),
+            "finished": finished,
+            "jobs_per_second": rate,
+            "queue_depth": queue,
+            "eta": remaining / rate if rate > 0 else None,
+            "stages": stages}
+
+
+def write_status(metrics, status_file, fmt="json"):
+    """Export the progress metrics of a workflow.
+
+    Parameters
+    ----------
+    metrics : dict,
+        progress metrics (see progress).
+    status_file : str,
+        destination file.
+    fmt : str in ["json", "prometheus"], optional (default="json")
+        "json" appends a JSON line, "prometheus" (atomically) replaces
+        the file with the Prometheus text format.
+    """
+    if fmt == "json":
+        with open(status_file, 'a') as fd:
+            fd.write(json.dumps(metrics, sort_keys=True) + "\n")
+        return
+    elif fmt != "prometheus":
+        raise TypeError("Invalid status format '{}'".format(fmt))
+    lines = ["# TYPE mempamal_jobs gauge"]
+    for stage in sorted(metrics["stages"]):
+        counts = metrics["stages"][stage]
+        for state in sorted(counts):
+            lines.append("mempamal_jobs{{stage=\"{}\",state=\"{}\"}} {}"
+                         .format(stage, state, counts[state]))
+    for key, metric in (("elapsed", "elapsed_seconds"),
+                        ("n_jobs", "jobs_total"),
+                        ("finished", "jobs_finished"),
+                        ("jobs_per_second", "jobs_per_second"),
+                        ("queue_depth", "queue_depth"),
+                        ("eta", "eta_seconds")):
+        if metrics[key] is not None:
+            lines.append("# TYPE mempamal_{} gauge".format(metric))
+            lines.append("mempamal_{} {}".format(metric, metrics[key]))
+    tmp = "{}.tmp{}".format(status_file, os.getpid())
+    with open(tmp, 'w') as fd:
+        fd.write("\n".join(lines) + "\n")
+    os.rename(tmp, status_file)
+
+
+def run_wf(wf, n_procs=1, timeout=None, retries=0, speculate=None,
+           slowdown=1.5, threads=None, poll=0.1, status_file=None,
+           status_format="json", verbose=False):
+    """Run a workflow (see create_wf) with local processes.
+
+    Stragglers: once a fraction (speculate) of the siblings of a job
+    have finished, a duplicate of the job is launched if it is running
+    for longer than slowdown times the median duration of its finished
+    siblings. The first copy to finish wins and the other one is killed
+    (the scripts write their results atomically, see
+    storage.atomic_dump).
+
+    Parameters
+    ----------
+    wf : tuple (cmd-dict, dependancies[, metadata]),
+        Workflow to run.
+    n_procs : int, optional (default=1)
+        maximum number of simultaneous processes.
+    timeout : float, optional (default=None)
+        time limit (in seconds) of a job, the "timeout" of the job
+        metadata takes precedence.
+    retries : int, optional (default=0)
+        number of retries of a failed (or timed out) job.
+    speculate : float in ]0, 1], optional (default=None, i.e. disabled)
+        fraction of finished siblings before duplicating a lagging job.
+    slowdown : float, optional (default=1.5)
+        a job is lagging if it runs for longer than slowdown times the
+        median duration of its finished siblings.
+    threads : int or "auto", optional (default=None)
+        thread budget of the jobs without one in their metadata ("auto":
+        the number of cores divided by n_procs).
+    poll : float, optional (default=0.1)
+        polling period (in seconds).
+    status_file : str, optional (default=None)
+        file updated with the progress metrics (see progress) each
+        time a job starts or finishes.
+    status_format : str in ["json", "prometheus"], optional
+                    (default="json")
+        format of the status file (see write_status).
+    verbose : boolean, optional (default=False)
+        verbose mode.
+
+    Returns
+    -------
+    status : dict,
+        final status of each job ("done", "failed" or "skipped").
+    """
+    cmd = wf[0]
+    dep = wf[1]
+    meta = wf[2] if len(wf) > 2 else {}
+    preds, siblings = _graph(cmd, dep)
+    status = dict((name, "waiting") for name in cmd)
+    running = {}
+    durations = {}
+    attempts = dict((name, 0) for name in cmd)
+    if threads == "auto":
+        threads = thread_budget(multiprocessing.cpu_count(), n_procs)
+    start_wf = time.time()
+
+    def launch(name, duplicate=False):
+        if verbose:
+            print("{} {}".format("Duplicate" if duplicate else "Start",
+                                 name))
+        env = meta.get(name, {}).get("env")
+        if env is None and threads is not None:
+            env = thread_env(threads)
+        if env is not None:
+            env = dict(os.environ, **env)
+        proc = subprocess.Popen(cmd[name], env=env)
+        running.setdefault(name, []).append((proc, time.time()))
+        if not duplicate:
+            attempts[name] += 1
+        status[name] = "running"
+
+    while running or "waiting" in status.values():
+        now = time.time()
+        previous = dict(status)
+        # check the running copies
+        for name in list(running):
+            job_timeout = meta.get(name, {}).get("timeout", timeout)
+            still, success = [], False
+            for proc, start in running[name]:
+                ret = proc.poll()
+                if (ret is None and job_timeout is not None and
+                        now - start > job_timeout):
+                    _kill(proc)
+                    ret = "timeout"
+                if ret is None:
+                    still.append((proc, start))
+                elif ret == 0 and not success:
+                    success = True
+                    durations[name] = now - start
+                elif verbose:
+                    print("{} exited: {}".format(name, ret))
+            if success:
+                for proc, start in still:
+                    _kill(proc)
+                del running[name]
+                status[name] = "done"
+                if verbose:
+                    print("Done {} ({:.1f}s)".format(name, durations[name]))
+            elif not still:
+                del running[name]
+                status[name] = ("waiting" if attempts[name] <= retries
+                                else "failed")
+            else:
+                running[name] = still
+
+        # skip the jobs depending on a failed job
+        changed = True
+        while changed:
+            changed = False
+            for name in cmd:
+                if status[name] == "waiting" and any(
+                        status[p] in ("failed", "skipped")
+                        for p in preds[name]):
+                    status[name] = "skipped"
+                    changed = True
+
+        # launch the ready jobs
+        n_running = sum(len(c) for c in running.values())
+        for name in sorted(cmd):
+            if n_running >= n_procs:
+                break
+            if status[name] == "waiting" and all(
+                    status[p] == "done" for p in preds[name]):
+                launch(name)
+                n_running += 1
+
+        # speculative duplicates of the stragglers
+        if speculate is not None:
+            for name in sorted(running):
+                if n_running >= n_procs:
+                    break
+                if len(running[name]) > 1:
+                    continue
+                done = [durations[s] for s in siblings[name]
+                        if status[s] == "done"]
+                if (len(done) >= speculate * len(siblings[name]) and
+                        now - running[name][0][1] >
+                        slowdown * np.median(done)):
+                    launch(name, duplicate=True)
+                    n_running += 1
+
+        # export the progress
+        if status_file is not None and status != previous:
+            write_status(progress(status, meta, preds, start_wf),
+                         status_file, fmt=status_format)
+        time.sleep(poll)
+    if status_file is not None:
+        write_status(progress(status, meta, preds, start_wf),
+                     status_file, fmt=status_format)
+    return status
+
+
+def run_array_jobs(manifest, n_procs=1, verbose=False, **kwargs):
+    """Run the array jobs of a workflow (see save_wf with mode "array-job")
+    with local processes.
+
+    Stand-in for the batch scheduler: each task runs its array script
+    with its task ID and an array starts once all the tasks of the
+    arrays it depends on are done.
+
+    Parameters
+    ----------
+    manifest : str or dict,
+        manifest of the array jobs (or its JSON file).
+    n_procs : int, optional (default=1)
+        maximum number of simultaneous processes.
+    verbose : boolean, optional (default=False)
+        verbose mode.
+    kwargs : dict,
+        other arguments of run_wf (e.g. timeout or retries).
+
+    Returns
+    -------
+    status : dict,
+        final status of each task ("array[task ID]").
+    """
+    if not isinstance(manifest, dict):
+        with open(manifest, 'r') as fd:
+            manifest = json.load(fd)
+    first = manifest["first_index"]
+    cmd = {}
+    dep = []
+    meta = {}
+    for array in manifest["arrays"]:
+        name = array["name"]
+        barrier = "{} (start)".format(name)
+        # no-op job between an array and the arrays it depends on
+        cmd[barrier] = ["true"]
+        meta[barrier] = {"stage": "barrier"}
+        for d in array["depends"]:
+            for t in xrange(first, first + _array_size(manifest, d)):
+                dep.append(("{}[{}]".format(d, t), barrier))
+        for t in xrange(first, first + array["n_tasks"]):
+            task = "{}[{}]".format(name, t)
+            cmd[task] = ["sh", array["script"], repr(t)]
+            meta[task] = {"stage": name}
+            dep.append((barrier, task))
+    status = run_wf((cmd, dep, meta), n_procs=n_procs, verbose=verbose,
+                    **kwargs)
+    return dict((name, st) for name, st in status.iteritems()
+                if meta[name]["stage"] != "barrier")
+
+
+def _array_size(manifest, name):
+    """Number of tasks of an array job of a manifest.
+
+    Note: internal function (see run_array_jobs)
+    """
+    for array in manifest["arrays"]:
+        if array["name"] == name:
+            return array["n_tasks"]
+    raise KeyError("Unknown array job \'{}\'".format(name))
@@ -6,6 +6,8 @@
 Generic inner reducer
 """
 import json
+import os.path as path
+import sys
 import numpy as np
 
 from sklearn.externals import joblib
@@ -13,8 +15,14 @@ from sklearn.pipeline import Pipeline
 
 from mempamal.arguments import get_ired_argparser
 from mempamal.crossval import get_fold, print_fold
-from mempamal.gridsearch import GenericGridSearch
-from mempamal.dynamic import construct_pipeline, get_score_func
+from mempamal.dynamic import (construct_pipeline, get_methods,
+                              get_score_func, method_grid)
+from mempamal.linear import get_engine
+from mempamal.preprocessing import get_fold_stats
+from mempamal.resources import memory_info
+from mempamal.search import load_inner_results
+from mempamal.storage import (atomic_dump, block_columns, get_fold_data,
+                              load_dataset)
 
 verbose = False
 
@@ -27,63 +35,116 @@ if __name__ == "__main__":
         print(args)
         print("=======")
 
+    # adaptive outer CV: this outer fold is not needed anymore
+    if args.stop_file is not None and path.exists(args.stop_file):
+        print("Stop file found: {}".format(args.stop_file))
+        sys.exit(0)
+
     # read files
-    dataset = joblib.load(args.dataset)
+    # the fold index file (if any) avoids loading X
+    dataset = load_dataset(args.dataset if args.folds is None
+                           else args.folds, mmap_mode="r")
     with open(args.method, 'r') as fd:
         method_cfg = json.load(fd)
     with open(args.crossval, 'r') as fd:
         cv_cfg = json.load(fd)
 
-    # retrieve results from inner folds
     n_inner = dataset["folds"]["n_inner"]
-    n_targets = dataset["n_targets"]
-    grid = dataset["grid"]
-    scores = np.zeros((n_inner, n_targets, len(grid)))
-    for i in range(n_inner):
-        cur_file = (args.__getattribute__("in")).format(inner=i)
+    score_func, score_kwargs = get_score_func(cv_cfg, cv="gridSearch")
+    spec = (None if args.speculative is None
+            else joblib.load(args.speculative))
+    warm = (None if args.warm_start is None
+            else joblib.load(args.warm_start))
+    fold_data = None
+    all_scores = {}
+    best_params = {}
+    for name, m_cfg in get_methods(method_cfg):
+        # retrieve results from inner folds (and search rounds)
+        grid, scores = load_inner_results(args.__getattribute__("in"),
+                                          n_inner, n_rounds=args.rounds,
+                                          grid=method_grid(dataset["grid"],
+                                                           name),
+                                          method=name, verbose=verbose)
         if verbose:
-            print("Reading {}".format(cur_file))
-        cur_ar = joblib.load(cur_file)
-        scores[i] = cur_ar["scores"]
-    if verbose:
-        print("=======")
-    # Parameter selection:
-    # mean on the folds and target, i.e. select the best parameters
-    # independently of the target (that's one possible strategy for
-    # multiple targets)
-    ms = np.mean(scores.reshape((-1, len(grid))), axis=0)
-    bid = np.where(ms == np.amax(ms))[0]
-    best_param = grid[bid[0]]
+            print("=======")
+        # Parameter selection:
+        # mean on the folds and target, i.e. select the best parameters
+        # independently of the target (that's one possible strategy for
+        # multiple targets)
+        ms = np.mean(scores.reshape((-1, len(grid))), axis=0)
+        bid = np.where(ms == np.amax(ms))[0]
+        best_param = grid[bid[0]]
 
-    # construct folds
-    train_index, test_index = get_fold(dataset["folds"], args.outer)
-    if verbose:
-        print_fold(train_index, test_index)
-    X = dataset["X"]
-    Y = dataset["Y"]
-    X_train = X[train_index]
-    Y_train = Y[train_index]
-    X_test = X[test_index]
-    Y_test = Y[test_index]
+        # an outer-train fit of the best parameters may have been
+        # speculatively scored in parallel with the inner folds
+        best_scores = None
+        if spec is not None:
+            spec_grid = method_grid(spec["grid"], name)
+            if best_param in spec_grid:
+                idx = spec_grid.index(best_param)
+                spec_scores = (spec["scores"] if name is None
+                               else spec["scores"][name])
+                best_scores = np.asarray(spec_scores)[..., idx]
+                if verbose:
+                    print("Speculative result found in {}".format(
+                            args.speculative))
 
-    # construct estimator
-    est_kwargs, est_param = construct_pipeline(method_cfg)
-    score_func, score_kwargs = get_score_func(cv_cfg, cv="gridSearch")
-    clf = GenericGridSearch(est=Pipeline,
-                            params=[best_param],
-                            est_kwargs=est_kwargs,
-                            score_func=score_func,
-                            score_kwargs=score_kwargs)
+        if best_scores is None:
+            if fold_data is None:
+                if args.folds is not None:
+                    dataset = load_dataset(args.dataset, mmap_mode="r")
+                # construct folds
+                train_index, test_index = get_fold(dataset["folds"],
+                                                   args.outer)
+                if verbose:
+                    print_fold(train_index, test_index)
+                # feature block: column slice of the features
+                columns = None
+                if args.n_blocks is not None:
+                    columns = block_columns(dataset["X"].shape[1],
+                                            args.block, args.n_blocks)
+                fold_data = get_fold_data(dataset, train_index, test_index,
+                                          columns=columns)
+                fold_stats = get_fold_stats(
+                    dataset, args.outer, columns=columns,
+                    base_dir=path.dirname(args.dataset))
+            X_train, Y_train, X_test, Y_test = fold_data
 
-    # fit/predict/score
-    clf.fit(X_train, Y_train)
-    Y_pred = clf.predict(X_test)
-    if verbose:
-        print Y_test
-        print Y_pred[0]
-    res = {"scores": clf.score(Y_test, Y_pred)[0]}
-    print("Best parameters set: {}".format(best_param))
-    print("scores: {}".format(res["scores"]))
+            # construct estimator
+            est_kwargs, est_param = construct_pipeline(m_cfg)
+            clf = get_engine(m_cfg)(est=Pipeline,
+                                    params=[best_param],
+                                    est_kwargs=est_kwargs,
+                                    score_func=score_func,
+                                    score_kwargs=score_kwargs,
+                                    fold_stats=fold_stats)
+
+            # fit/predict/score (warm started from an inner fold)
+            init = None
+            if warm is not None:
+                init = warm if name is None else warm[name]
+            clf.fit(X_train, Y_train, init=init)
+            Y_pred = clf.predict(X_test)
+            if verbose:
+                print Y_test
+                print Y_pred[0]
+            best_scores = clf.score(Y_test, Y_pred)[0]
+        all_scores[name] = best_scores
+        best_params[name] = best_param
+        print("Best parameters set{}: {}".format(
+                "" if name is None else " ({})".format(name), best_param))
+        print("scores: {}".format(best_scores))
+
+    if "methods" not in method_cfg:
+        # single method
+        all_scores = all_scores[None]
+        best_params = best_params[None]
+    res = {"scores": all_scores, "best_params": best_params}
+    if fold_data is None:
+        res["memory"] = memory_info("inner_reducer", dataset)
+    else:
+        res["memory"] = memory_info("inner_reducer", dataset,
+                                    fold_data[0], fold_data[2])
 
     # save result
-    joblib.dump(res, args.out, compress=1)
+    atomic_dump(res, args.out)
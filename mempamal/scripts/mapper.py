@@ -6,14 +6,23 @@
 Generic mapper
 """
 import json
+import os
+import os.path as path
+import sys
+import warnings
 
 from sklearn.externals import joblib
 from sklearn.pipeline import Pipeline
 
 from mempamal.arguments import get_map_argparser
 from mempamal.crossval import get_fold, print_fold
-from mempamal.gridsearch import GenericGridSearch
-from mempamal.dynamic import construct_pipeline, get_score_func
+from mempamal.dynamic import (construct_pipeline, get_methods,
+                              get_score_func, method_grid)
+from mempamal.linear import get_engine
+from mempamal.preprocessing import get_fold_stats
+from mempamal.resources import memory_info
+from mempamal.storage import (atomic_dump, block_columns, get_fold_data,
+                              load_dataset)
 
 verbose = False
 
@@ -26,46 +35,114 @@ if __name__ == "__main__":
         print(args)
         print("=======")
 
+    # adaptive outer CV: this outer fold is not needed anymore
+    if args.stop_file is not None and path.exists(args.stop_file):
+        print("Stop file found: {}".format(args.stop_file))
+        sys.exit(0)
+
     # read data and configuration files
-    dataset = joblib.load(args.dataset)
-    grid = dataset["grid"]
+    # memory-mapped: only the rows (and columns) of the fold are read
+    dataset = load_dataset(args.dataset, mmap_mode="r")
+    grid = (dataset["grid"] if args.grid is None
+            else joblib.load(args.grid))
+    if args.params is not None:
+        grid = [grid[k] for k in args.params]
     with open(args.crossval, 'r') as fd:
         cv_cfg = json.load(fd)
     with open(args.method, 'r') as fd:
         method_cfg = json.load(fd)
 
-    # construct folds
-    train_index, test_index = get_fold(dataset["folds"],
-                                       args.outer, inner=args.inner)
-    if verbose:
-        print_fold(train_index, test_index)
-    X = dataset["X"]
-    Y = dataset["Y"]
-    X_train = X[train_index]
-    Y_train = Y[train_index]
-    X_test = X[test_index]
-    Y_test = Y[test_index]
-
-    # construct estimator
-    est_kwargs, est_param = construct_pipeline(method_cfg)
     which_cv = ("gridSearch" if cv_cfg["modelSelection"]
                 else "crossval_score")
     score_func, score_kwargs = get_score_func(cv_cfg, cv=which_cv)
-    clf = GenericGridSearch(est=Pipeline,
-                            params=grid,
-                            est_kwargs=est_kwargs,
-                            score_func=score_func,
-                            score_kwargs=score_kwargs)
+    # batch mode: the inner folds in turn, each one warm started from the
+    # fitted estimators of the previous one
+    warm = args.batch or args.warm_save is not None
+    inners = (range(dataset["folds"]["n_inner"]) if args.batch
+              else [args.inner])
+    models = {}
+    # checkpoints: a restarted job with the same arguments and the same
+    # dataset file (not rebuilt in place) resumes
+    data_stat = os.stat(args.dataset)
+    signature = repr((sorted((k, v) for k, v in vars(args).iteritems()
+                             if k != "verbose"),
+                      data_stat.st_mtime, data_stat.st_size,
+                      dataset["X"].shape))
+    # feature block: column slice of the features
+    columns = None
+    if args.n_blocks is not None:
+        columns = block_columns(dataset["X"].shape[1], args.block,
+                                args.n_blocks)
+    for inner in inners:
+        # construct folds
+        train_index, test_index = get_fold(dataset["folds"],
+                                           args.outer, inner=inner)
+        if verbose:
+            print_fold(train_index, test_index)
+        X_train, Y_train, X_test, Y_test = get_fold_data(dataset,
+                                                         train_index,
+                                                         test_index,
+                                                         columns=columns)
+        fold_stats = get_fold_stats(dataset, args.outer, inner,
+                                    columns=columns,
+                                    base_dir=path.dirname(args.dataset))
 
-    # fit/predict/score
-    clf.fit(X_train, Y_train)
-    Y_pred = clf.predict(X_test)
-    if verbose:
-        print Y_test
-        print Y_pred
-    scores = clf.score(Y_test, Y_pred)
-    res = ({"scores": scores} if cv_cfg["modelSelection"]
-           else {"scores": scores[0]})
+        out_file = args.out.format(inner=inner) if args.batch else args.out
+        checkpoints = []
+
+        # construct estimators (the fold data are shared by all the
+        # methods)
+        all_scores = {}
+        all_grids = {}
+        for name, m_cfg in get_methods(method_cfg):
+            m_grid = method_grid(grid, name)
+            est_kwargs, est_param = construct_pipeline(m_cfg)
+            clf = get_engine(m_cfg)(est=Pipeline,
+                                    params=m_grid,
+                                    est_kwargs=est_kwargs,
+                                    score_func=score_func,
+                                    score_kwargs=score_kwargs,
+                                    fold_stats=fold_stats)
+
+            # fit/predict/score (the warm start keeps the estimators)
+            ckpt = None
+            if args.checkpoint:
+                ckpt = "{}{}.ckpt".format(out_file, "" if name is None
+                                          else "." + name)
+                checkpoints.append(ckpt)
+            if warm and m_cfg.get("streaming", False):
+                warnings.warn("Streaming is disabled by the warm start "
+                              "(the estimators are kept)", RuntimeWarning)
+            if ((m_cfg.get("streaming", False) or ckpt is not None) and
+                    not warm):
+                scores = clf.fit_score(X_train, Y_train, X_test, Y_test,
+                                       checkpoint=ckpt, signature=signature)
+            else:
+                clf.fit(X_train, Y_train, init=models.get(name))
+                Y_pred = clf.predict(X_test)
+                if verbose:
+                    print Y_test
+                    print Y_pred
+                scores = clf.score(Y_test, Y_pred)
+                if warm:
+                    models[name] = clf.res
+            all_scores[name] = (scores if cv_cfg["modelSelection"]
+                                else scores[0])
+            all_grids[name] = m_grid
+        if "methods" not in method_cfg:
+            # single method
+            all_scores = all_scores[None]
+            all_grids = all_grids[None]
+        res = ({"scores": all_scores, "grid": all_grids}
+               if cv_cfg["modelSelection"] else {"scores": all_scores})
+        res["memory"] = memory_info("mapper", dataset, X_train, X_test)
+
+        # save result (the checkpoints are not needed anymore)
+        atomic_dump(res, out_file)
+        for ckpt in checkpoints:
+            if path.exists(ckpt):
+                os.remove(ckpt)
 
-    # save result
-    joblib.dump(res, args.out, compress=1)
+    if args.warm_save is not None:
+        atomic_dump(models if "methods" in method_cfg else models[None],
+                    args.warm_save)
@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+# Author: Benoit Da Mota <damota.benoit@gmail.com>
+#
+# License: BSD 3 clause
+"""
+Batched inner reducer: a model selection per dataset of a container (see
+configuration.build_datasets).
+"""
+import json
+import os.path as path
+import sys
+import numpy as np
+
+from sklearn.externals import joblib
+from sklearn.pipeline import Pipeline
+
+from mempamal.arguments import get_ired_argparser
+from mempamal.crossval import get_fold, print_fold
+from mempamal.dynamic import construct_pipeline, get_score_func
+from mempamal.linear import get_engine
+from mempamal.preprocessing import get_fold_stats
+from mempamal.resources import dataset_nbytes, memory_info
+from mempamal.storage import atomic_dump, get_fold_data
+
+verbose = False
+
+if __name__ == "__main__":
+    # parse command line arguments
+    args = get_ired_argparser().parse_args()
+    verbose = args.verbose
+    if verbose:
+        print("=======")
+        print(args)
+        print("=======")
+
+    # adaptive outer CV: this outer fold is not needed anymore
+    if args.stop_file is not None and path.exists(args.stop_file):
+        print("Stop file found: {}".format(args.stop_file))
+        sys.exit(0)
+
+    # read files
+    container = joblib.load(args.dataset)
+    with open(args.method, 'r') as fd:
+        method_cfg = json.load(fd)
+    with open(args.crossval, 'r') as fd:
+        cv_cfg = json.load(fd)
+
+    # retrieve results from inner folds (once for all the datasets)
+    n_inner = container["folds"]["n_inner"]
+    inner_res = []
+    for k in xrange(n_inner):
+        cur_file = args.__getattribute__("in").format(inner=k, round=0)
+        if verbose:
+            print("Reading {}".format(cur_file))
+        inner_res.append(joblib.load(cur_file))
+    grid = inner_res[-1].get("grid")
+    if grid is None:
+        grid = container["grid"]
+
+    score_func, score_kwargs = get_score_func(cv_cfg, cv="gridSearch")
+    est_kwargs, est_param = construct_pipeline(method_cfg)
+    engine = get_engine(method_cfg)
+    all_scores = {}
+    best_params = {}
+    for name in container["names"]:
+        # Parameter selection (same strategy as the inner reducer)
+        scores = np.asarray([np.atleast_2d(r["scores"][name])
+                             for r in inner_res])
+        ms = np.mean(scores.reshape((-1, len(grid))), axis=0)
+        bid = np.where(ms == np.amax(ms))[0]
+        best_param = grid[bid[0]]
+
+        # construct folds
+        dataset = container["datasets"][name]
+        train_index, test_index = get_fold(dataset["folds"], args.outer)
+        if verbose:
+            print("Dataset {}".format(name))
+            print_fold(train_index, test_index)
+        X_train, Y_train, X_test, Y_test = get_fold_data(dataset,
+                                                         train_index,
+                                                         test_index)
+
+        # construct estimator, fit/predict/score
+        clf = engine(est=Pipeline,
+                     params=[best_param],
+                     est_kwargs=est_kwargs,
+                     score_func=score_func,
+                     score_kwargs=score_kwargs,
+                     fold_stats=get_fold_stats(dataset, args.outer))
+        clf.fit(X_train, Y_train)
+        all_scores[name] = clf.score(Y_test, clf.predict(X_test))[0]
+        best_params[name] = best_param
+        if verbose:
+            print("Best parameters set ({}): {}".format(name, best_param))
+            print("scores: {}".format(all_scores[name]))
+
+    res = {"scores": all_scores, "best_params": best_params}
+    res["memory"] = memory_info("multi_inner_reducer")
+    res["memory"]["dataset_nbytes"] = sum(
+        dataset_nbytes(d) for d in container["datasets"].itervalues())
+
+    # save result
+    atomic_dump(res, args.out)
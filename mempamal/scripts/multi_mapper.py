@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+# Author: Benoit Da Mota <damota.benoit@gmail.com>
+#
+# License: BSD 3 clause
+"""
+Batched mapper: a fold of all the datasets of a container (see
+configuration.build_datasets).
+"""
+import json
+import os.path as path
+import sys
+
+from sklearn.externals import joblib
+from sklearn.pipeline import Pipeline
+
+from mempamal.arguments import get_map_argparser
+from mempamal.crossval import get_fold, print_fold
+from mempamal.dynamic import construct_pipeline, get_score_func
+from mempamal.linear import get_engine
+from mempamal.preprocessing import get_fold_stats
+from mempamal.resources import dataset_nbytes, memory_info
+from mempamal.storage import atomic_dump, get_fold_data
+
+verbose = False
+
+if __name__ == "__main__":
+    # parse command line arguments
+    args = get_map_argparser().parse_args()
+    verbose = args.verbose
+    if verbose:
+        print("=======")
+        print(args)
+        print("=======")
+
+    # adaptive outer CV: this outer fold is not needed anymore
+    if args.stop_file is not None and path.exists(args.stop_file):
+        print("Stop file found: {}".format(args.stop_file))
+        sys.exit(0)
+
+    # read data and configuration files
+    container = joblib.load(args.dataset)
+    grid = container["grid"]
+    if args.params is not None:
+        grid = [grid[k] for k in args.params]
+    with open(args.crossval, 'r') as fd:
+        cv_cfg = json.load(fd)
+    with open(args.method, 'r') as fd:
+        method_cfg = json.load(fd)
+
+    which_cv = ("gridSearch" if cv_cfg["modelSelection"]
+                else "crossval_score")
+    score_func, score_kwargs = get_score_func(cv_cfg, cv=which_cv)
+    est_kwargs, est_param = construct_pipeline(method_cfg)
+    engine = get_engine(method_cfg)
+
+    # the datasets in turn (same fold IDs, their own folds)
+    all_scores = {}
+    for name in container["names"]:
+        dataset = container["datasets"][name]
+        train_index, test_index = get_fold(dataset["folds"], args.outer,
+                                           inner=args.inner)
+        if verbose:
+            print("Dataset {}".format(name))
+            print_fold(train_index, test_index)
+        X_train, Y_train, X_test, Y_test = get_fold_data(dataset,
+                                                         train_index,
+                                                         test_index)
+        clf = engine(est=Pipeline,
+                     params=grid,
+                     est_kwargs=est_kwargs,
+                     score_func=score_func,
+                     score_kwargs=score_kwargs,
+                     fold_stats=get_fold_stats(dataset, args.outer,
+                                               args.inner))
+        if method_cfg.get("streaming", False):
+            scores = clf.fit_score(X_train, Y_train, X_test, Y_test)
+        else:
+            clf.fit(X_train, Y_train)
+            scores = clf.score(Y_test, clf.predict(X_test))
+        all_scores[name] = (scores if cv_cfg["modelSelection"]
+                            else scores[0])
+    res = ({"scores": all_scores, "grid": grid}
+           if cv_cfg["modelSelection"] else {"scores": all_scores})
+    res["memory"] = memory_info("multi_mapper")
+    res["memory"]["dataset_nbytes"] = sum(
+        dataset_nbytes(d) for d in container["datasets"].itervalues())
+
+    # save result
+    atomic_dump(res, args.out)
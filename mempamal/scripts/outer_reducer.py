@@ -5,12 +5,16 @@
 """
 Generic outer reducer.
 """
+import os
+import os.path as path
 from glob import glob
 
 import numpy as np
 from sklearn.externals import joblib
 
 from mempamal.arguments import get_ored_argparser
+from mempamal.resources import memory_info
+from mempamal.storage import atomic_dump
 
 verbose = False
 
@@ -23,30 +27,100 @@ if __name__ == "__main__":
         print(args)
         print("=======")
 
-    # retrieve results from (outer) folds
-    file_pattern = (args.__getattribute__("in")).format(outer="*")
-    list_files = glob(file_pattern)
-    scores = []
-    for cur_file in list_files:
-        if verbose:
-            print("Reading {}".format(cur_file))
-        cur_ar = joblib.load(cur_file)
-        scores.append(cur_ar["scores"])
-    raw = np.asarray(scores)
-
-    # summary
-    res = {"raw": raw,
-           "mean": np.mean(raw, axis=0),
-           "median": np.median(raw, axis=0),
-           "std": np.std(raw, axis=0)}
+    # retrieve results from (outer) folds, by feature block
+    block_scores = []
+    for b in xrange(1 if args.n_blocks is None else args.n_blocks):
+        file_pattern = (args.__getattribute__("in")).format(outer="*",
+                                                            block=b)
+        list_files = sorted(glob(file_pattern))
+        scores = []
+        for cur_file in list_files:
+            if verbose:
+                print("Reading {}".format(cur_file))
+            cur_ar = joblib.load(cur_file)
+            scores.append(cur_ar["scores"])
+        block_scores.append(scores)
+    if args.n_blocks is not None:
+        # stack the blocks (second axis of the raw scores)
+        if len(set(len(sc) for sc in block_scores)) > 1:
+            raise ValueError("Feature blocks with different numbers of "
+                             "outer folds")
+        scores = []
+        for fold_scores in zip(*block_scores):
+            if isinstance(fold_scores[0], dict):
+                scores.append(dict((n, np.asarray([sc[n]
+                                                   for sc in fold_scores]))
+                                   for n in fold_scores[0]))
+            else:
+                scores.append(np.asarray(fold_scores))
+
+    # summary (by method if the results hold several methods)
+    if scores and isinstance(scores[0], dict):
+        names = sorted(scores[0])
+        raw = dict((n, np.asarray([sc[n] for sc in scores])) for n in names)
+    else:
+        names = [None]
+        raw = {None: np.asarray(scores)}
+    n_folds = len(scores)
+    res = {"raw": {}, "mean": {}, "median": {}, "std": {}, "sem": {}}
+    for n in names:
+        res["raw"][n] = raw[n]
+        res["mean"][n] = np.mean(raw[n], axis=0)
+        res["median"][n] = np.median(raw[n], axis=0)
+        res["std"][n] = np.std(raw[n], axis=0)
+        # standard error of the mean
+        res["sem"][n] = (np.std(raw[n], axis=0, ddof=1) / np.sqrt(n_folds)
+                         if n_folds > 1 else np.inf)
+    if names == [None]:
+        # single method
+        for k in ("raw", "mean", "median", "std", "sem"):
+            res[k] = res[k][None]
+    res["n_folds"] = n_folds
+
+    # adaptive outer CV: stop once the scores are stable enough
+    if args.tol is not None:
+        max_sem = max(np.amax(res["sem"] if n is None else res["sem"][n])
+                      for n in names) if scores else np.inf
+        res["converged"] = bool(n_folds >= args.min_folds and
+                                max_sem < args.tol)
+        print("{} outer fold(s), SEM={} (tol={}): {}".format(
+                n_folds, max_sem, args.tol,
+                "stop" if res["converged"] else "continue"))
+        if args.stop_file is not None:
+            if res["converged"]:
+                with open(args.stop_file, 'w') as fd:
+                    fd.write("{}\n".format(n_folds))
+            elif path.exists(args.stop_file):
+                # stop file of a previous run
+                os.remove(args.stop_file)
+    res["memory"] = memory_info("outer_reducer")
     if verbose:
         print("=======")
         print(res)
         print("=======")
-    print("Cross-validated score(s):")
-    print("  Mean  : %s" % (res['mean']).__str__())
-    print("  Median: %s" % (res['median']).__str__())
-    print("  Std   : %s" % (res['std']).__str__())
+    if args.table is not None:
+        # one line per dataset (or method), "," between the targets
+        stats = ("mean", "median", "std", "sem")
+        tmp = args.table + ".tmp"
+        with open(tmp, 'w') as fd:
+            fd.write("\t".join(("name", "n_folds") + stats) + "\n")
+            for n in names:
+                values = [",".join("%g" % v for v in np.ravel(
+                            res[k] if n is None else res[k][n]))
+                          for k in stats]
+                fd.write("\t".join(["" if n is None else str(n),
+                                    str(n_folds)] + values) + "\n")
+        os.rename(tmp, args.table)
+        print("Summary table ({} rows): {}".format(len(names), args.table))
+    for n in ([] if args.table is not None else names):
+        summary = res if n is None else dict(
+            (k, res[k][n]) for k in ("mean", "median", "std", "sem"))
+        print("Cross-validated score(s){}:".format(
+                "" if n is None else " ({})".format(n)))
+        print("  Mean  : %s" % (summary['mean']).__str__())
+        print("  Median: %s" % (summary['median']).__str__())
+        print("  Std   : %s" % (summary['std']).__str__())
+        print("  SEM   : %s" % (summary['sem']).__str__())
 
     # save result
-    joblib.dump(res, args.out, compress=1)
+    atomic_dump(res, args.out)
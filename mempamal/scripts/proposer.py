@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+# Author: Benoit Da Mota <damota.benoit@gmail.com>
+#
+# License: BSD 3 clause
+"""
+Generic proposer (sequential model-based search).
+"""
+import json
+import os.path as path
+import sys
+import numpy as np
+
+from mempamal.arguments import get_prop_argparser
+from mempamal.search import (get_search_conf, load_inner_results,
+                             propose_params, round_size)
+from mempamal.storage import atomic_dump, load_dataset
+
+verbose = False
+
+if __name__ == "__main__":
+    # parse command line arguments
+    args = get_prop_argparser().parse_args()
+    verbose = args.verbose
+    if verbose:
+        print("=======")
+        print(args)
+        print("=======")
+
+    # adaptive outer CV: this outer fold is not needed anymore
+    if args.stop_file is not None and path.exists(args.stop_file):
+        print("Stop file found: {}".format(args.stop_file))
+        sys.exit(0)
+
+    # read files
+    # the fold index file (if any) avoids loading X
+    dataset = load_dataset(args.dataset if args.folds is None
+                           else args.folds, mmap_mode="r")
+    with open(args.crossval, 'r') as fd:
+        cv_cfg = json.load(fd)
+    search = get_search_conf(cv_cfg)
+
+    # retrieve results from inner folds of the previous rounds
+    n_inner = dataset["folds"]["n_inner"]
+    grid, scores = load_inner_results(args.__getattribute__("in"), n_inner,
+                                      n_rounds=args.round,
+                                      grid=dataset["grid"], verbose=verbose)
+    # same strategy as the inner reducer to rank the parameters
+    ms = np.mean(scores.reshape((-1, len(grid))), axis=0)
+
+    # propose the grid of the current round
+    seed = search.get("random_state")
+    rng = np.random.RandomState(None if seed is None else
+                                [seed, args.outer, args.round])
+    new_grid = propose_params(search["distributions"], grid, ms,
+                              round_size(search, args.round),
+                              random_state=rng)
+    if verbose:
+        print("Best score so far: {}".format(np.amax(ms)))
+        print("Proposed grid: {}".format(new_grid))
+
+    # save result
+    atomic_dump(new_grid, args.out)
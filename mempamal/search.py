@@ -0,0 +1,290 @@
+# Author: Benoit Da Mota <damota.benoit@gmail.com>
+#
+# License: BSD 3 clause
+"""
+Randomized and sequential (model-based) search of hyper-parameters.
+
+The search space is a JSON-able dict associating a parameter name
+(e.g. "logit__C") with a distribution:
+  - ["uniform", low, high]
+  - ["loguniform", low, high]
+  - ["randint", low, high] (high excluded)
+  - ["choice", [value_1, value_2, ...]]
+"""
+import numpy as np
+from sklearn.externals import joblib
+
+
+def _check_random_state(seed):
+    """Turn seed into a np.random.RandomState instance.
+
+    """
+    if isinstance(seed, np.random.RandomState):
+        return seed
+    return np.random.RandomState(seed)
+
+
+def _to_unit(dist, val):
+    """Map values of a numerical distribution in [0, 1].
+
+    """
+    kind, low, high = dist
+    if kind == "loguniform":
+        return (np.log(val) - np.log(low)) / (np.log(high) - np.log(low))
+    return (np.asarray(val, dtype=np.float64) - low) / float(high - low)
+
+
+def _from_unit(dist, u):
+    """Map values in [0, 1] to a numerical distribution.
+
+    """
+    kind, low, high = dist
+    u = np.clip(u, 0., 1.)
+    if kind == "loguniform":
+        return np.exp(np.log(low) + u * (np.log(high) - np.log(low)))
+    elif kind == "randint":
+        return np.minimum(np.floor(low + u * (high - low)),
+                          high - 1).astype(int)
+    return low + u * (high - low)
+
+
+def _to_python(val):
+    """Convert numpy scalars to python scalars (JSON-able grid).
+
+    """
+    return val.item() if isinstance(val, np.generic) else val
+
+
+def sample_params(distributions, n_iter, random_state=None):
+    """Sample a grid of parameters from distributions.
+
+    Parameters
+    ----------
+    distributions : dict,
+        search space (see module documentation).
+    n_iter : int,
+        number of parameters to sample.
+    random_state : int or RandomState, optional (default=None)
+        pseudo random number generator state.
+
+    Returns
+    -------
+    grid : list of dict,
+        grid of parameters (see GenericGridSearch).
+    """
+    rng = _check_random_state(random_state)
+    columns = {}
+    for name in sorted(distributions):
+        dist = distributions[name]
+        if dist[0] == "choice":
+            idx = rng.randint(len(dist[1]), size=n_iter)
+            columns[name] = [dist[1][k] for k in idx]
+        elif dist[0] in ("uniform", "loguniform", "randint"):
+            columns[name] = _from_unit(dist, rng.uniform(size=n_iter))
+        else:
+            raise TypeError("Unknown distribution \'{}\'".format(dist[0]))
+    return [dict((name, _to_python(columns[name][k])) for name in columns)
+            for k in range(n_iter)]
+
+
+def _log_density(distributions, grid, points, bandwidth):
+    """Log-density of a Parzen estimator fitted on points, evaluated on grid.
+
+    Each parameter is modeled independently: a mixture of gaussians
+    (in the unit space) for numerical distributions and smoothed
+    frequencies for choices.
+    """
+    log_d = np.zeros(len(grid))
+    for name, dist in distributions.items():
+        if dist[0] == "choice":
+            values = list(dist[1])
+            counts = np.ones(len(values))
+            for p in points:
+                counts[values.index(p[name])] += 1.
+            prob = counts / counts.sum()
+            log_d += np.log([prob[values.index(g[name])] for g in grid])
+        else:
+            u_grid = _to_unit(dist, [g[name] for g in grid])
+            # the uniform prior is a component of the mixture
+            u_pts = np.append(_to_unit(dist, [p[name] for p in points]), 0.5)
+            bw = np.append(np.repeat(bandwidth, len(points)), 1.)
+            diff = (u_grid[:, np.newaxis] - u_pts) / bw
+            dens = np.mean(np.exp(-0.5 * diff ** 2) / bw, axis=1)
+            log_d += np.log(dens + 1e-12)
+    return log_d
+
+
+def propose_params(distributions, grid, scores, n_propose,
+                   random_state=None, n_candidates=100, gamma=0.25):
+    """Propose new parameters from the scores of the evaluated ones.
+
+    Tree-structured Parzen estimator flavour: the evaluated parameters
+    are split between the best fraction (gamma) and the others, and the
+    candidates (sampled from the search space) maximizing the ratio of
+    the densities are proposed.
+
+    Parameters
+    ----------
+    distributions : dict,
+        search space (see module documentation).
+    grid : list of dict,
+        evaluated parameters.
+    scores : array, shape (n_parameters)
+        scores of the evaluated parameters (greater is better).
+    n_propose : int,
+        number of parameters to propose.
+    random_state : int or RandomState, optional (default=None)
+        pseudo random number generator state.
+    n_candidates : int, optional (default=100)
+        number of candidates sampled per proposed parameter.
+    gamma : float, optional (default=0.25)
+        fraction of the evaluated parameters considered as good.
+
+    Returns
+    -------
+    grid : list of dict,
+        proposed parameters.
+    """
+    rng = _check_random_state(random_state)
+    scores = np.asarray(scores, dtype=np.float64)
+    order = np.argsort(scores)[::-1]
+    n_good = max(1, int(np.ceil(gamma * len(grid))))
+    good = [grid[k] for k in order[:n_good]]
+    bad = [grid[k] for k in order[n_good:]]
+    bandwidth = max(1. / np.sqrt(len(grid)), 0.05)
+    candidates = sample_params(distributions, n_candidates * n_propose,
+                               random_state=rng)
+    ratio = (_log_density(distributions, candidates, good, bandwidth) -
+             _log_density(distributions, candidates, bad, bandwidth))
+    proposed = []
+    seen = set(tuple(sorted(p.items())) for p in grid)
+    for k in np.argsort(ratio)[::-1]:
+        key = tuple(sorted(candidates[k].items()))
+        if key not in seen:
+            seen.add(key)
+            proposed.append(candidates[k])
+        if len(proposed) == n_propose:
+            break
+    return proposed
+
+
+def get_search_conf(cv_cfg):
+    """Return the search configuration of the gridSearch (or None).
+
+    Parameters
+    ----------
+    cv_cfg : dict,
+        configuration dict for cross-validation.
+    """
+    if not cv_cfg["modelSelection"]:
+        return None
+    return cv_cfg["gridSearch"].get("search")
+
+
+def n_rounds(search_cfg):
+    """Number of propose/evaluate rounds for a search configuration.
+
+    Parameters
+    ----------
+    search_cfg : dict,
+        search configuration (see configuration.JSONify_cv).
+    """
+    if search_cfg is None or search_cfg["strategy"] == "random":
+        return 1
+    n_per_round = search_cfg["n_per_round"]
+    return int(np.ceil(search_cfg["budget"] / float(n_per_round)))
+
+
+def round_size(search_cfg, round_id):
+    """Number of parameters evaluated during a given round.
+
+    Parameters
+    ----------
+    search_cfg : dict,
+        search configuration (see configuration.JSONify_cv).
+    round_id : int,
+        ID of the round.
+    """
+    if search_cfg["strategy"] == "random":
+        return search_cfg["budget"]
+    n_per_round = search_cfg["n_per_round"]
+    return min(n_per_round, search_cfg["budget"] - round_id * n_per_round)
+
+
+def initial_grid(search_cfg):
+    """Sample the grid of the first round of a search configuration.
+
+    Parameters
+    ----------
+    search_cfg : dict,
+        search configuration (see configuration.JSONify_cv).
+    """
+    return sample_params(search_cfg["distributions"],
+                         round_size(search_cfg, 0),
+                         random_state=search_cfg.get("random_state"))
+
+
+def load_inner_results(in_template, n_inner, n_rounds=1, grid=None,
+                       method=None, verbose=False):
+    """Gather the grid and the scores of the inner folds over the rounds.
+
+    Parameters
+    ----------
+    in_template : str,
+        filename template of the mapper results (with {inner} and
+        optionally {round} fields).
+    n_inner : int,
+        number of inner folds.
+    n_rounds : int, optional (default=1)
+        number of rounds to gather.
+    grid : list of dict, optional (default=None)
+        grid used if a mapper result does not provide its grid.
+    method : str, optional (default=None)
+        name of the method (results of several methods, see
+        configuration.JSONify_methods).
+    verbose : boolean, optional (default=False)
+        verbose mode.
+
+    Returns
+    -------
+    grid : list of dict,
+        all the evaluated parameters.
+    scores : array, shape (n_inner, n_targets, n_parameters)
+        scores of the evaluated parameters.
+    """
+    all_grid = []
+    all_scores = []
+    for r in range(n_rounds):
+        scores = []
+        for i in range(n_inner):
+            cur_file = in_template.format(inner=i, round=r)
+            if verbose:
+                print("Reading {}".format(cur_file))
+            cur_ar = joblib.load(cur_file)
+            cur_scores = cur_ar["scores"]
+            if method is not None:
+                cur_scores = cur_scores[method]
+            scores.append(np.atleast_2d(cur_scores))
+        cur_grid = cur_ar.get("grid")
+        if cur_grid is None:
+            cur_grid = grid
+        elif method is not None:
+            cur_grid = cur_grid[method]
+        all_grid.extend(cur_grid)
+        all_scores.append(np.asarray(scores))
+    return all_grid, np.concatenate(all_scores, axis=-1)
+
+
+def rank_params(scores, k=None):
+    """Indices of the k best parameters (e.g. from a pilot run).
+
+    Parameters
+    ----------
+    scores : array, shape (n_inner, n_targets, n_parameters)
+        scores of the parameters (see load_inner_results).
+    k : int, optional (default=None, i.e. all the parameters)
+        number of parameters to return.
+    """
+    scores = np.asarray(scores)
+    ms = np.mean(scores.reshape((-1, scores.shape[-1])), axis=0)
+    return [int(p) for p in np.argsort(ms)[::-1][:k]]
@@ -0,0 +1,426 @@
+# Author: Benoit Da Mota <damota.benoit@gmail.com>
+#
+# License: BSD 3 clause
+"""
+Functions relative to the storage of the dataset (encoding and fold data).
+"""
+import hashlib
+import os
+import os.path as path
+
+import numpy as np
+import sklearn.externals.joblib as joblib
+
+from mempamal.crossval import get_fold
+from mempamal.preprocessing import train_stats
+
+
+def encode_features(X, dtype=None, compute_dtype=None):
+    """Encode the features array following a dtype policy.
+
+    A floating point dtype (e.g. "float32") simply casts X. An integer
+    dtype (e.g. "int16") quantizes each column linearly between its
+    minimum and its maximum, the scale and the offset being stored in
+    the codec to decode the features (X = X_enc * scale + offset).
+
+    Parameters
+    ----------
+    X : array, shape (n_samples, n_features)
+        features array
+    dtype : str or numpy.dtype, optional (default=None, i.e. keep X)
+        storage dtype for the features.
+    compute_dtype : str or numpy.dtype, optional (default=None)
+        dtype of the decoded features. By default, the storage dtype
+        for floating points and "float32" for integers.
+
+    Returns
+    -------
+    X_enc : array, shape (n_samples, n_features)
+        encoded features array
+    codec : dict or None,
+        information to decode the features (see decode_features)
+    """
+    if dtype is None:
+        return X, None
+    dtype = np.dtype(dtype)
+    if dtype.kind == "f":
+        compute_dtype = dtype if compute_dtype is None else compute_dtype
+        X_enc = X.astype(dtype)
+        codec = {"dtype": dtype.str}
+    elif dtype.kind == "i":
+        compute_dtype = "float32" if compute_dtype is None else compute_dtype
+        info = np.iinfo(dtype)
+        x_min = np.min(X, axis=0).astype(np.float64)
+        x_max = np.max(X, axis=0).astype(np.float64)
+        scale = (x_max - x_min) / (float(info.max) - info.min)
+        scale[scale == 0.] = 1.
+        offset = x_min - info.min * scale
+        X_enc = np.round((X - offset) / scale)
+        X_enc = np.clip(X_enc, info.min, info.max).astype(dtype)
+        codec = {"dtype": dtype.str, "scale": scale, "offset": offset}
+    else:
+        raise TypeError("Unsupported storage dtype \'{}\'".format(dtype))
+    codec["compute_dtype"] = np.dtype(compute_dtype).str
+    return X_enc, codec
+
+
+def decode_features(X_enc, codec=None):
+    """Decode (a slice of) an encoded features array.
+
+    Parameters
+    ----------
+    X_enc : array, shape (n_samples, n_features)
+        encoded features array
+    codec : dict, optional (default=None, i.e. X_enc is not encoded)
+        information to decode the features (see encode_features)
+    """
+    if codec is None:
+        return X_enc
+    compute_dtype = np.dtype(codec["compute_dtype"])
+    if "scale" in codec:
+        X = X_enc.astype(compute_dtype)
+        X *= codec["scale"].astype(compute_dtype)
+        X += codec["offset"].astype(compute_dtype)
+        return X
+    return X_enc.astype(compute_dtype, copy=False)
+
+
+def precision_report(X, X_enc, codec=None):
+    """Measure the error introduced by the encoding of the features.
+
+    Parameters
+    ----------
+    X : array, shape (n_samples, n_features)
+        original features array
+    X_enc : array, shape (n_samples, n_features)
+        encoded features array
+    codec : dict, optional (default=None)
+        information to decode the features (see encode_features)
+    """
+    err = decode_features(X_enc, codec).astype(np.float64) - X
+    std = np.std(X, axis=0)
+    std[std == 0.] = 1.
+    return {"dtype": X_enc.dtype.str,
+            "nbytes": X_enc.nbytes,
+            "orig_nbytes": X.nbytes,
+            "max_abs_error": float(np.max(np.abs(err))),
+            "max_rel_rmse": float(np.max(np.sqrt(np.mean(err ** 2, axis=0))
+                                         / std))}
+
+
+def block_columns(n_features, block, n_blocks):
+    """Columns of a feature block (contiguous blocks of balanced sizes).
+
+    Parameters
+    ----------
+    n_features : int,
+        number of features.
+    block : int,
+        ID of the block.
+    n_blocks : int,
+        number of blocks.
+    """
+    if not 0 <= block < n_blocks:
+        raise ValueError("Invalid feature block {} (n_blocks={})".format(
+                block, n_blocks))
+    q, r = divmod(n_features, n_blocks)
+    start = block * q + min(block, r)
+    return slice(start, start + q + (block < r))
+
+
+def get_fold_data(dataset, train_index, test_index, columns=None):
+    """Get the (decoded) train and test data of a fold.
+
+    Parameters
+    ----------
+    dataset : dict,
+        the dataset (see configuration.build_dataset).
+    train_index : array,
+        indices of the training samples.
+    test_index : array,
+        indices of the testing samples.
+    columns : slice, optional (default=None, i.e. all the features)
+        columns of a feature block (see block_columns).
+
+    Returns
+    -------
+    X_train, Y_train, X_test, Y_test
+
+    Notes
+    -----
+    With a precomputed kernel (see compute_kernel), X_train is
+    K[train][:, train] and X_test is K[test][:, train].
+
+    With a memory-mapped X (see load_dataset), only the pages holding
+    the rows (and columns) of the fold are read: a feature block reads
+    about its share of X when a row spans several pages.
+    """
+    X = dataset["X"]
+    Y = dataset["Y"]
+    codec = dataset.get("codec")
+    if dataset.get("kernel") is not None:
+        if columns is not None:
+            raise ValueError("Feature blocks are incompatible with a "
+                             "precomputed kernel")
+        return (decode_features(X[np.ix_(train_index, train_index)], codec),
+                Y[train_index],
+                decode_features(X[np.ix_(test_index, train_index)], codec),
+                Y[test_index])
+    if columns is not None:
+        codec = _block_codec(codec, columns)
+        return (decode_features(X[train_index, columns], codec),
+                Y[train_index],
+                decode_features(X[test_index, columns], codec),
+                Y[test_index])
+    return (decode_features(X[train_index], codec), Y[train_index],
+            decode_features(X[test_index], codec), Y[test_index])
+
+
+def _block_codec(codec, columns):
+    """Codec of a feature block (see encode_features).
+
+    Note: internal function (see get_fold_data)
+    """
+    if codec is None or "scale" not in codec:
+        return codec
+    return dict(codec, scale=codec["scale"][columns],
+                offset=codec["offset"][columns])
+
+
+def compute_kernel(X, kernel="linear", kernel_kwargs=None):
+    """Compute the kernel matrix of the samples.
+
+    For n_features >> n_samples problems, the (n_samples, n_samples)
+    kernel replaces X and feeds estimators with kernel="precomputed"
+    (e.g. sklearn.svm.SVC or sklearn.kernel_ridge.KernelRidge).
+
+    Parameters
+    ----------
+    X : array, shape (n_samples, n_features)
+        features array
+    kernel : str, optional (default="linear")
+        kernel metric (see sklearn.metrics.pairwise.pairwise_kernels).
+    kernel_kwargs : dict, optional (default=None)
+        keywords arguments for the kernel.
+    """
+    if kernel == "linear" and not kernel_kwargs:
+        return np.dot(X, X.T)
+    from sklearn.metrics.pairwise import pairwise_kernels
+    kernel_kwargs = {} if kernel_kwargs is None else kernel_kwargs
+    return pairwise_kernels(X, metric=kernel, **kernel_kwargs)
+
+
+def atomic_dump(value, filename, compress=1):
+    """Write a joblib file atomically (write then rename).
+
+    Readers never see a partial file and concurrent writers (e.g.
+    speculative duplicates of a job) do not corrupt the result. A
+    compression level > 0 keeps joblib to a single file.
+
+    Parameters
+    ----------
+    value : object,
+        object to store.
+    filename : str,
+        destination file.
+    compress : int, optional (default=1)
+        compression level for joblib (> 0).
+    """
+    tmp = "{}.tmp{}".format(filename, os.getpid())
+    joblib.dump(value, tmp, compress=compress)
+    os.rename(tmp, filename)
+
+
+def array_hash(a):
+    """Content hash (sha1) of an array (dtype, shape and data).
+
+    Parameters
+    ----------
+    a : array,
+        the array to hash.
+    """
+    a = np.ascontiguousarray(a)
+    h = hashlib.sha1()
+    h.update("{}{}".format(a.dtype.str, a.shape).encode("utf-8"))
+    h.update(a.data if a.dtype != object else repr(a.tolist()).encode())
+    return h.hexdigest()
+
+
+def store_array(a, store, relative_to=None):
+    """Write an array in a content-addressed store (once per content).
+
+    Parameters
+    ----------
+    a : array,
+        the array to store.
+    store : str,
+        directory of the store, shared across experiments.
+    relative_to : str, optional (default=None, i.e. absolute path)
+        the reference holds the store path relative to this directory
+        (e.g. the directory of the dataset file).
+
+    Returns
+    -------
+    ref : dict,
+        reference to the array (see load_array).
+
+    Notes
+    -----
+    Arrays of Python objects are not supported (ValueError).
+    """
+    a = np.asarray(a)
+    if a.dtype == object:
+        # np.load would require pickles and cannot memory-map them
+        raise ValueError("Object arrays cannot be stored (keep them in "
+                         "the dataset file)")
+    sha1 = array_hash(a)
+    fname = path.join(store, sha1[:2], sha1 + ".npy")
+    if not path.exists(fname):
+        if not path.isdir(path.dirname(fname)):
+            os.makedirs(path.dirname(fname))
+        # atomic write (concurrent experiments share the store)
+        tmp = "{}.tmp{}".format(fname, os.getpid())
+        with open(tmp, 'wb') as fd:
+            np.save(fd, a)
+        os.rename(tmp, fname)
+    store = (path.abspath(store) if relative_to is None
+             else path.relpath(path.abspath(store),
+                               path.abspath(relative_to)))
+    return {"sha1": sha1, "store": store,
+            "dtype": a.dtype.str, "shape": a.shape}
+
+
+def _is_ref(value):
+    """Is a dataset value a reference to a stored array?
+
+    Note: internal function (see load_dataset)
+    """
+    return isinstance(value, dict) and "sha1" in value and "store" in value
+
+
+def load_array(ref, base_dir=".", mmap_mode=None):
+    """Load an array from a content-addressed store.
+
+    Parameters
+    ----------
+    ref : dict,
+        reference to the array (see store_array).
+    base_dir : str, optional (default=".")
+        base of a relative store path.
+    mmap_mode : str, optional (default=None)
+        memory-map the array (see numpy.load).
+    """
+    fname = path.join(base_dir, ref["store"], ref["sha1"][:2],
+                      ref["sha1"] + ".npy")
+    return np.load(fname, mmap_mode=mmap_mode)
+
+
+def load_dataset(filename, mmap_mode=None):
+    """Load a dataset file and resolve its references to stored arrays.
+
+    Parameters
+    ----------
+    filename : str,
+        the dataset file (see configuration.build_dataset).
+    mmap_mode : str, optional (default=None)
+        memory-map the arrays of the dataset file (if not compressed)
+        and the stored arrays (see numpy.load), so that a job only
+        reads the rows of its fold.
+    """
+    dataset = joblib.load(filename, mmap_mode=mmap_mode)
+    for k, v in dataset.items():
+        if _is_ref(v):
+            dataset[k] = load_array(v, base_dir=path.dirname(filename),
+                                    mmap_mode=mmap_mode)
+    return dataset
+
+
+def _sub_dataset(dataset, rows, folds, src, stats_keys=()):
+    """Dataset restricted to some rows with re-indexed folds (and the
+    training statistics of some folds).
+
+    Note: internal function (see write_fold_files)
+    """
+    folds = dict(folds, src=src, n_outer=dataset["folds"]["n_outer"])
+    if "n_inner" in dataset["folds"]:
+        folds["n_inner"] = dataset["folds"]["n_inner"]
+    X = dataset["X"]
+    X = X[np.ix_(rows, rows)] if dataset.get("kernel") is not None else X[rows]
+    sub = dict(dataset, X=X, Y=dataset["Y"][rows],
+               n_samples=rows.size, folds=folds)
+    if dataset.get("stats") is not None:
+        # statistics of a training set do not depend on the rows order
+        stats = dataset["stats"]
+        sub["stats"] = {"target": stats["target"],
+                        "folds": dict((k, train_stats(stats, k))
+                                      for k in stats_keys)}
+    return sub
+
+
+def write_fold_files(dataset, level="outer", staging_dir=".", compress=0,
+                     verbose=False):
+    """Materialize per-fold (or per-outer-fold) datasets.
+
+    Each file is a dataset (see configuration.build_dataset) with only
+    the samples of its fold(s) and re-indexed folds, so a job only
+    transfers the rows it needs. The outer-level files are always
+    written (inner reducers, outer-level and batched mappers).
+
+    Parameters
+    ----------
+    dataset : dict,
+        the dataset (see configuration.build_dataset).
+    level : str in ["outer", "fold"], optional (default="outer")
+        one file per outer fold or one file per (inner) fold.
+    staging_dir : str, optional (default=".")
+        directory for the fold files.
+    compress : int, optional (default=0)
+        compression level for joblib.
+    verbose : boolean, optional (default=False)
+        verbose mode.
+
+    Returns
+    -------
+    files : dict,
+        fold files names by fold key (e.g. "0" or "0_1").
+    """
+    if level not in ("outer", "fold"):
+        raise ValueError("Unknown fold files level \'{}\'".format(level))
+    folds = dataset["folds"]
+    n_inner = folds.get("n_inner", 0)
+    files = {"level": level, "dir": staging_dir}
+    for i in range(folds["n_outer"]):
+        train, test = get_fold(folds, i)
+        rows = np.concatenate((train, test))
+        sub_folds = {"%d" % i: (np.arange(train.size),
+                                np.arange(train.size, rows.size))}
+        # position of the samples in the outer training set
+        pos = np.zeros(dataset["n_samples"], dtype=int)
+        pos[train] = np.arange(train.size)
+        for k in range(n_inner):
+            key = "%d_%d" % (i, k)
+            itrain, itest = get_fold(folds, i, inner=k)
+            # inner folds index the outer training set
+            sub_folds[key] = (pos[itrain], pos[itest])
+            if level == "fold":
+                n_tr, n_te = itrain.size, itest.size
+                fname = "fold_{}.joblib".format(key)
+                cur_folds = {"%d" % i: (np.arange(n_tr + n_te),
+                                        np.array([], dtype=int)),
+                             key: (np.arange(n_tr),
+                                   np.arange(n_tr, n_tr + n_te))}
+                sub = _sub_dataset(dataset,
+                                   np.concatenate((itrain, itest)),
+                                   cur_folds, fname, stats_keys=[key])
+                joblib.dump(sub, path.join(staging_dir, fname),
+                            compress=compress)
+                files[key] = fname
+        fname = "fold_{}.joblib".format(i)
+        sub = _sub_dataset(dataset, rows, sub_folds, fname,
+                           stats_keys=[k for k in sub_folds])
+        joblib.dump(sub, path.join(staging_dir, fname), compress=compress)
+        files["%d" % i] = fname
+        if verbose:
+            print("Fold files of outer fold {} written in {}".format(
+                    i, staging_dir))
+    return files
@@ -4,14 +4,46 @@
 """
 Workflow generation.
 """
+import os
 import os.path as path
+import re
+from string import Formatter
 import numpy as np
 
+from mempamal.crossval import get_fold
+from mempamal.dynamic import construct_pipeline, get_methods
+from mempamal.gridsearch import warm_startable
+from mempamal.resources import (estimate_memory, pack_jobs, thread_budget,
+                                thread_env)
+from mempamal.search import get_search_conf, n_rounds
+from mempamal.storage import block_columns
+
+
+def _data_file(folds_dic, in_out_dir, outer, inner=None):
+    """Path of the dataset file required by a job (see build_dataset and
+    storage.write_fold_files).
+
+    Note: internal function (see create_wf)
+    """
+    files = folds_dic.get("files")
+    if files is None:
+        return path.join(in_out_dir, folds_dic["src"])
+    staging_dir = in_out_dir if files["dir"] is None else files["dir"]
+    if inner is not None and files["level"] == "fold":
+        return path.join(staging_dir, files["%d_%d" % (outer, inner)])
+    return path.join(staging_dir, files["%d" % outer])
+
 
 def _create_generic(folds_dic, cv_cfg, method_cfg, in_out_dir,
                     mapper="./scripts/mapper.py",
                     i_red="./scripts/inner_reducer.py",
                     o_red="./scripts/outer_reducer.py",
+                    proposer="./scripts/proposer.py",
+                    speculative=None,
+                    adaptive=None,
+                    warm_start=False,
+                    n_blocks=None,
+                    checkpoint=False,
                     verbose=False):
     """Create a workflow (list of commands and dependancies).
 
@@ -19,44 +51,151 @@ def _create_generic(folds_dic, cv_cfg, method_cfg, in_out_dir,
     """
     # construct paths
     cv = path.join(in_out_dir, cv_cfg["src"])
-    folds = path.join(in_out_dir, folds_dic["src"])
     method = path.join(in_out_dir, method_cfg["src"])
     # results filenames
     m_out = path.join(in_out_dir, "map_res_{outer}_{inner}.pkl")
     ri_out = path.join(in_out_dir, "red_res_{outer}.pkl")
+    sp_out = path.join(in_out_dir, "spec_res_{outer}.pkl")
+    w_out = path.join(in_out_dir, "warm_{outer}.pkl")
     ro_out = path.join(in_out_dir, "final_res.pkl")
 
+    # fold index file (see build_dataset)
+    idx_cmd = []
+    if "index_src" in folds_dic:
+        idx_cmd = ["--folds", path.join(in_out_dir, folds_dic["index_src"])]
+
     # number of folds
     n_o = folds_dic["n_outer"]
     n_i = folds_dic["n_inner"] if cv_cfg["modelSelection"] else None
 
+    if warm_start and checkpoint:
+        raise ValueError("Warm start mappers keep their estimators and "
+                         "cannot be checkpointed")
+    if warm_start and any(m_cfg.get("streaming", False)
+                          for _, m_cfg in get_methods(method_cfg)):
+        raise ValueError("Warm start mappers keep their estimators and "
+                         "cannot stream them")
+    if warm_start:
+        for _, m_cfg in get_methods(method_cfg):
+            final = construct_pipeline(m_cfg)[0]["steps"][-1][1][0]
+            if not warm_startable(final()):
+                raise ValueError("Warm start requires a final step that "
+                                 "starts from its coefficients (coordinate "
+                                 "descent, SGD or LogisticRegression), not "
+                                 "{}".format(final.__name__))
+
+    # sequential search: iterative propose/evaluate rounds
+    n_r = n_rounds(get_search_conf(cv_cfg))
+    if speculative not in (None, "all") and "methods" in method_cfg:
+        raise ValueError("Speculative grid indices are ambiguous with "
+                         "several methods (use \"all\")")
+    if n_r > 1:
+        if "methods" in method_cfg:
+            raise ValueError("Sequential search supports a single method")
+        if speculative is not None:
+            raise ValueError("Speculative refits require the grid in "
+                             "advance (incompatible with sequential search)")
+        if warm_start:
+            raise ValueError("Warm start is incompatible with sequential "
+                             "search")
+        m_out = path.join(in_out_dir, "map_res_{outer}_{inner}_{round}.pkl")
+        g_out = path.join(in_out_dir, "grid_{outer}_{round}.pkl")
+
+    # several datasets in a container (see configuration.build_datasets)
+    multi = "datasets" in folds_dic
+    if multi and (n_r > 1 or speculative is not None or warm_start or
+                  n_blocks is not None or checkpoint):
+        raise ValueError("Several datasets are incompatible with sequential "
+                         "search, speculative refits, warm start, feature "
+                         "blocks and checkpoints")
+
     # a workflow is a collection of commands and dependancies
     all_cmd = {}
     # dependancies are tuples (cmd_nameA, cmd_nameB) stored in a dict
     # with cmd_B that waits for cmd_A completion
     dependancies = []
+    # metadata of the jobs (stage, folds, resources)
+    meta = {}
     name_ired = "|--- Inner reduce outer={}"
     name_ored = "|- Final reduce"
 
     for i in xrange(n_o):
+        folds = _data_file(folds_dic, in_out_dir, i)
         cmd_mapper = ["python", mapper, cv, method, folds]
         name_cur_ired = name_ired.format(i)
         if cv_cfg["modelSelection"]:
-            for k in xrange(n_i):
-                cur_cmd = (cmd_mapper +
-                           [m_out.format(inner=k, outer=i), repr(i),
-                            "--inner", repr(k)])
-                name = "|----- Map outer={} inner={}".format(i, k)
+            prev_names = []
+            for r in xrange(n_r):
+                round_cmd = []
+                if r > 0:
+                    # propose the grid of this round from the previous ones
+                    name_prop = "|---- Propose outer={} round={}".format(i, r)
+                    cmd_prop = ["python", proposer, cv, method, folds,
+                                g_out.format(outer=i, round=r),
+                                m_out.format(outer=i, inner="{inner}",
+                                             round="{round}"),
+                                repr(i), repr(r)] + idx_cmd
+                    all_cmd[name_prop] = cmd_prop
+                    meta[name_prop] = dict(stage="propose", outer=i, round=r)
+                    for name in prev_names:
+                        dependancies.append((name, name_prop))
+                    round_cmd = ["--grid", g_out.format(outer=i, round=r)]
+                    if verbose:
+                        print(" ".join(cmd_prop))
+                prev_names = []
+                if warm_start:
+                    # a single job evaluates the inner folds in turn
+                    cur_cmd = (["python", mapper, cv, method, folds,
+                                m_out.format(inner="{inner}", outer=i),
+                                repr(i), "--batch",
+                                "--warm-save", w_out.format(outer=i)])
+                    name = "|----- Map outer={} inner=all".format(i)
+                    all_cmd[name] = cur_cmd
+                    meta[name] = dict(stage="map", outer=i, round=r)
+                    dependancies.append((name, name_cur_ired))
+                    if verbose:
+                        print(" ".join(cur_cmd))
+                    continue
+                for k in xrange(n_i):
+                    cur_cmd = (["python", mapper, cv, method,
+                                _data_file(folds_dic, in_out_dir, i, k),
+                                m_out.format(inner=k, outer=i, round=r),
+                                repr(i), "--inner", repr(k)] + round_cmd)
+                    name = "|----- Map outer={} inner={}".format(i, k)
+                    if n_r > 1:
+                        name += " round={}".format(r)
+                    all_cmd[name] = cur_cmd
+                    meta[name] = dict(stage="map", outer=i, inner=k, round=r)
+                    prev_names.append(name)
+                    dependancies.append((name, name_cur_ired))
+                    if r > 0:
+                        dependancies.append((name_prop, name))
+                    if verbose:
+                        print(" ".join(cur_cmd))
+
+            cmd_i_red = ["python", i_red, cv, method, folds,
+                         ri_out.format(outer=i),
+                         m_out.format(outer=i, inner="{inner}",
+                                      round="{round}"),
+                         repr(i)] + idx_cmd
+            if n_r > 1:
+                cmd_i_red += ["--rounds", repr(n_r)]
+            if warm_start:
+                cmd_i_red += ["--warm-start", w_out.format(outer=i)]
+            if speculative is not None:
+                # outer-train fits scheduled in parallel with inner folds
+                cur_cmd = cmd_mapper + [sp_out.format(outer=i), repr(i)]
+                if speculative != "all":
+                    cur_cmd += ["--params"] + [repr(p) for p in speculative]
+                name = "|----- Speculative map outer={}".format(i)
                 all_cmd[name] = cur_cmd
+                meta[name] = dict(stage="map", outer=i)
                 dependancies.append((name, name_cur_ired))
+                cmd_i_red += ["--speculative", sp_out.format(outer=i)]
                 if verbose:
                     print(" ".join(cur_cmd))
-
-            cmd_i_red = ["python", i_red, cv, method, folds,
-                         ri_out.format(outer=i),
-                         m_out.format(outer=i, inner="{inner}"),
-                         repr(i)]
             all_cmd[name_cur_ired] = cmd_i_red
+            meta[name_cur_ired] = dict(stage="inner_reduce", outer=i)
             dependancies.append((name_cur_ired, name_ored))
             if verbose:
                 print("\n{}\n".format(" ".join(cmd_i_red)))
@@ -64,23 +203,194 @@ def _create_generic(folds_dic, cv_cfg, method_cfg, in_out_dir,
             cur_cmd = cmd_mapper + [ri_out.format(outer=i), repr(i)]
             name = "|--- Map outer={}".format(i)
             all_cmd[name] = cur_cmd
+            meta[name] = dict(stage="map", outer=i)
             dependancies.append((name, name_ored))
             if verbose:
                 print(" ".join(cur_cmd))
-    cmd_o_red = ["python", o_red, ro_out, ri_out]
+    if checkpoint:
+        for name, m in meta.iteritems():
+            if m["stage"] == "map":
+                all_cmd[name] = all_cmd[name] + ["--checkpoint"]
+    o_red_cmd = []
+    if n_blocks is not None:
+        results = [m_out, ri_out, sp_out, w_out] + ([g_out] if n_r > 1
+                                                    else [])
+        _set_blocks(all_cmd, dependancies, meta, n_blocks, name_ored,
+                    results)
+        ri_out = _block_file(ri_out, "{block}")
+        o_red_cmd = ["--n-blocks", repr(n_blocks)]
+    if adaptive is not None:
+        _set_waves(all_cmd, dependancies, meta, adaptive, in_out_dir,
+                   o_red, ri_out, name_ored, o_red_cmd, verbose=verbose)
+    cmd_o_red = ["python", o_red, ro_out, ri_out] + o_red_cmd
+    if multi:
+        cmd_o_red += ["--table", path.join(in_out_dir, "summary.tsv")]
     all_cmd[name_ored] = cmd_o_red
+    meta[name_ored] = dict(stage="outer_reduce")
     if verbose:
         print(" ".join(cmd_o_red))
-    return all_cmd, dependancies
+    return all_cmd, dependancies, meta
+
+
+def _block_file(filename, block):
+    """Result filename of a feature block.
+
+    Note: internal function (see _set_blocks)
+    """
+    root, ext = path.splitext(filename)
+    return "{}_b{}{}".format(root, block, ext)
+
+
+def _template_regex(template):
+    """Regular expression matching a filename template whose fields are
+    formatted (digits) or not.
+
+    Note: internal function (see _set_blocks)
+    """
+    regex = ""
+    for literal, field, _, _ in Formatter().parse(template):
+        regex += re.escape(literal)
+        if field is not None:
+            regex += r"(?:\d+|\{%s\})" % field
+    return re.compile(regex + "$")
+
+
+def _set_blocks(all_cmd, dependancies, meta, n_blocks, name_ored, results):
+    """Split each job (but the final reducer) in feature blocks.
+
+    The jobs of a block only see a column slice of the features (see
+    storage.block_columns) and write their own results files: the
+    arguments matching a results filename template are renamed.
+
+    Note: internal function (see create_wf)
+    """
+    def block_name(name, b):
+        return name if name == name_ored else "{} block={}".format(name, b)
+
+    results = [_template_regex(t) for t in results]
+
+    new_dep = set()
+    for a, b in dependancies:
+        for k in xrange(n_blocks):
+            new_dep.add((block_name(a, k), block_name(b, k)))
+    for name in list(all_cmd):
+        cmd = all_cmd.pop(name)
+        m = meta.pop(name)
+        for k in xrange(n_blocks):
+            cur_cmd = [_block_file(c, k)
+                       if any(r.match(c) for r in results) else c
+                       for c in cmd]
+            if m["stage"] in ("map", "inner_reduce"):
+                cur_cmd += ["--block", repr(k), "--n-blocks", repr(n_blocks)]
+            all_cmd[block_name(name, k)] = cur_cmd
+            meta[block_name(name, k)] = dict(m, block=k)
+    dependancies[:] = sorted(new_dep)
+
 
+def _set_waves(all_cmd, dependancies, meta, adaptive, in_out_dir, o_red,
+               ri_out, name_ored, o_red_cmd, verbose=False):
+    """Split the outer folds in waves separated by checkpoint jobs.
+
+    A checkpoint job (an outer reducer on the outer folds done so far)
+    creates a stop file once the standard error of the mean score is
+    below the tolerance, the jobs of the next waves then exit
+    immediately.
+
+    Note: internal function (see create_wf)
+    """
+    wave_size = adaptive["wave_size"]
+    stop_file = path.join(in_out_dir, "stop_outer")
+    wave_out = path.join(in_out_dir, "wave_res_{}.pkl")
+    name_check = "|-- Checkpoint wave={}"
+    outer_jobs = list(all_cmd)
+    n_waves = int(np.ceil((max(meta[name]["outer"]
+                               for name in outer_jobs) + 1) /
+                          float(wave_size)))
+    for w in xrange(n_waves - 1):
+        name = name_check.format(w)
+        cmd = ["python", o_red, wave_out.format(w), ri_out,
+               "--tol", repr(adaptive["tol"]),
+               "--min-folds", repr(adaptive.get("min_folds", wave_size)),
+               "--stop-file", stop_file] + o_red_cmd
+        all_cmd[name] = cmd
+        meta[name] = dict(stage="outer_reduce", wave=w)
+        if w > 0:
+            dependancies.append((name_check.format(w - 1), name))
+        if verbose:
+            print(" ".join(cmd))
+    # jobs producing the outer folds results
+    producers = set(a for a, b in dependancies if b == name_ored)
+    for name in outer_jobs:
+        w = meta[name]["outer"] // wave_size
+        meta[name]["wave"] = w
+        if w < n_waves - 1 and name in producers:
+            dependancies.append((name, name_check.format(w)))
+        if w > 0:
+            dependancies.append((name_check.format(w - 1), name))
+            all_cmd[name] = all_cmd[name] + ["--stop-file", stop_file]
 
-def create_wf(folds_dic, cv_cfg, method_cfg, in_out_dir, verbose=False):
+
+def _set_memory(folds_dic, meta, memory, n_blocks=None, verbose=False):
+    """Attach the estimated memory (in MB) to the jobs metadata and pack
+    the jobs of each stage onto the nodes (if node_memory is provided):
+    node index and number of jobs of the stage on that node.
+
+    Note: internal function (see create_wf)
+    """
+    scripts = {"map": "mapper", "inner_reduce": "inner_reducer",
+               "outer_reduce": "outer_reducer", "propose": "proposer"}
+    for name, m in meta.iteritems():
+        n_samples = 0
+        if m["stage"] in ("map", "inner_reduce"):
+            train, test = get_fold(folds_dic, m["outer"], m.get("inner"))
+            n_samples = train.size + test.size
+        spec = memory
+        if "block" in m:
+            # columns of the feature block
+            columns = block_columns(memory["n_features"], m["block"],
+                                    n_blocks)
+            spec = dict(memory, n_features=len(xrange(
+                        *columns.indices(memory["n_features"]))))
+        m["memory"] = estimate_memory(spec, scripts[m["stage"]], n_samples)
+    if memory.get("node_memory") is not None:
+        for stage in scripts:
+            stage_mem = dict((name, m["memory"])
+                             for name, m in meta.iteritems()
+                             if m["stage"] == stage)
+            nodes = pack_jobs(stage_mem, memory["node_memory"])
+            # jobs sharing a node (see create_wf threads and the
+            # native_spec fields of save_wf)
+            node_jobs = np.bincount(nodes.values()) if nodes else []
+            for name, node in nodes.iteritems():
+                meta[name]["node"] = node
+                meta[name]["node_jobs"] = int(node_jobs[node])
+            if verbose and nodes:
+                print("{}: {} job(s) packed onto {} node(s)".format(
+                        stage, len(nodes), max(nodes.values()) + 1))
+
+
+def create_wf(folds_dic, cv_cfg, method_cfg, in_out_dir, speculative=None,
+              memory=None, timeout=None, threads=None, adaptive=None,
+              warm_start=False, n_blocks=None, checkpoint=False,
+              node_cores=None, verbose=False):
     """Create a workflow (list of commands and dependancies).
 
     the list of commands returned is a dictionnary which associates a
     job name and a command. A command is a list of strings. Dependancies
     are a list of tuples (cmd_nameA, cmd_nameB) where cmd_B waits for
-    cmd_A completion.
+    cmd_A completion. Metadata is a dictionnary which associates a job
+    name and a dict (stage, outer, inner and resources requirements).
+
+    With a sequential search in the cv_cfg (see
+    configuration.JSONify_cv), the inner folds of each outer fold are
+    evaluated in rounds, a proposer job between two rounds produces the
+    grid of the next round from the scores of the previous ones.
+
+    With the folds of a container of datasets (see
+    configuration.build_datasets), the jobs of a fold process all the
+    datasets in-process (multi_mapper.py and multi_inner_reducer.py) and
+    the outer reducer also writes a per-dataset summary table
+    (summary.tsv in in_out_dir).
 
     Parameters:
     -----------
@@ -92,38 +402,306 @@ def create_wf(folds_dic, cv_cfg, method_cfg, in_out_dir, verbose=False):
        Configuration for the data and I/O.
     method_cfg : dict,
        Configuration of the method.
+    in_out_dir : str,
+       Directory for the inputs and outputs.
+    speculative : "all" or list of int, optional (default=None)
+       Schedule an outer-train fit for all the grid parameters (or the
+       given grid indices, e.g. a predicted top-k, see
+       search.rank_params) in parallel with the inner folds. The inner
+       reducer then selects the already-scored result instead of
+       refitting (it refits if the best parameters were not scored).
+    memory : dict, optional (default=None)
+       Memory specification (see resources.memory_spec) to estimate the
+       memory (in MB) of each job and pack the jobs onto the nodes.
+    timeout : float, optional (default=None)
+       Time limit (in seconds) of the map jobs (see runner.run_wf).
+    threads : int or "auto", optional (default=None)
+       Thread budget of each job, applied through the BLAS/OpenMP
+       environment variables of the jobs. "auto": the cores of a node
+       (node_cores) divided by the number of jobs packed onto it (see
+       resources.thread_budget), it requires the node packing of
+       memory (node_memory).
+    adaptive : dict, optional (default=None)
+       Adaptive number of outer folds: {"wave_size": int, "tol": float
+       [, "min_folds": int]}. The outer folds are processed in waves
+       of wave_size folds, a checkpoint after each wave stops the next
+       waves once the standard error of the mean outer score is below
+       tol (with at least min_folds folds, default: wave_size). Use a
+       large number of outer folds (e.g. ShuffleSplit), the final
+       reducer only gathers the computed ones.
+    warm_start : boolean, optional (default=False)
+       A single map job per outer fold evaluates the inner folds in
+       turn, the estimators of each grid parameter start from the
+       solution of the previous inner fold (see
+       gridsearch.warm_startable, the other final steps, e.g. the
+       ensembles, are rejected). The inner reducer refit also starts
+       from the last inner solution. The estimators are kept, so
+       streaming methods and checkpoints are rejected.
+    n_blocks : int, optional (default=None)
+       Split the features in n_blocks column slices (e.g. regions for
+       feature-wise models): each (outer, inner, block) job runs
+       independently on its slice, a model is selected and evaluated
+       per block and the final reducer stacks the blocks (second axis
+       of the raw scores). The jobs memory-map the dataset file (if not
+       compressed) and only read the pages of their columns.
+    checkpoint : boolean, optional (default=False)
+       The map jobs checkpoint their scores after each grid parameter
+       (see GenericGridSearch.fit_score), a killed and restarted job
+       (e.g. on a preemptible queue) resumes where it stopped, unless
+       its dataset file was rebuilt in the meantime (its modification
+       time and size are part of the checkpoint signature).
+    node_cores : int, optional (default=None)
+       Number of cores of a node (threads="auto").
     verbose : boolean, optional (default=False)
         verbose mode.
+
+    Returns
+    -------
+    wf : tuple (cmd-dict, dependancies, metadata)
+        the workflow (see save_wf and runner.run_wf). Before the jobs
+        metadata, create_wf returned (cmd-dict, dependancies): use
+        wf[:2] for the old pair.
     """
     c_map = method_cfg["mapper"]
     c_i_red = method_cfg["inner_reducer"]
     c_o_red = method_cfg["outer_reducer"]
-    return _create_generic(folds_dic, cv_cfg, method_cfg, in_out_dir,
-                           mapper=c_map, i_red=c_i_red, o_red=c_o_red,
-                           verbose=verbose)
+    c_prop = method_cfg.get("proposer",
+                            path.join(path.dirname(c_map), "proposer.py"))
+    if "datasets" in folds_dic:
+        # batched scripts: all the datasets of a fold in-process
+        if memory is not None:
+            raise ValueError("Memory estimates require the folds of a "
+                             "single dataset")
+        c_map = method_cfg.get("multi_mapper", path.join(
+                path.dirname(c_map), "multi_mapper.py"))
+        c_i_red = method_cfg.get("multi_inner_reducer", path.join(
+                path.dirname(c_i_red), "multi_inner_reducer.py"))
+    wf = _create_generic(folds_dic, cv_cfg, method_cfg, in_out_dir,
+                         mapper=c_map, i_red=c_i_red, o_red=c_o_red,
+                         proposer=c_prop, speculative=speculative,
+                         adaptive=adaptive, warm_start=warm_start,
+                         n_blocks=n_blocks, checkpoint=checkpoint,
+                         verbose=verbose)
+    if memory is not None:
+        _set_memory(folds_dic, wf[2], memory, n_blocks=n_blocks,
+                    verbose=verbose)
+    if timeout is not None:
+        for m in wf[2].itervalues():
+            if m["stage"] == "map":
+                m["timeout"] = timeout
+    if threads == "auto":
+        # node cores shared by the jobs packed onto the node
+        if node_cores is None:
+            raise ValueError("threads=\"auto\" requires node_cores")
+        if memory is None or memory.get("node_memory") is None:
+            raise ValueError("threads=\"auto\" requires the node packing "
+                             "(memory with a node_memory)")
+        for m in wf[2].itervalues():
+            m["threads"] = thread_budget(node_cores, m["node_jobs"])
+            m["env"] = thread_env(m["threads"])
+    elif threads is not None:
+        for m in wf[2].itervalues():
+            m["threads"] = threads
+            m["env"] = thread_env(threads)
+    return wf
+
+
+def _native_spec(native_spec, fields, name):
+    """Format the native specification of a job with its metadata.
+
+    Note: internal function (see save_wf)
+    """
+    try:
+        return native_spec.format(**fields)
+    except KeyError as e:
+        raise KeyError("Job \'{}\' has no {} in its metadata for the "
+                       "native specification \'{}\' (e.g. memory requires "
+                       "create_wf(memory=...))".format(name, e, native_spec))
+
+
+def _array_groups(cmd, dep, meta, native_spec=None):
+    """Group the jobs in arrays: same stage and same depth in the
+    dependancies graph (an array only depends on previous arrays), split
+    by environment and native specification (but the memory, the
+    maximum of the tasks is requested).
+
+    Note: internal function (see save_wf)
+    """
+    preds = dict((name, set()) for name in cmd)
+    succs = dict((name, []) for name in cmd)
+    for a, b in dep:
+        if a not in cmd or b not in cmd:
+            raise ValueError("Dependancy on an unknown job: ({}, {})".format(
+                    a, b))
+        preds[b].add(a)
+        succs[a].append(b)
+    # depth in one topological pass
+    depth = {}
+    n_preds = dict((name, len(p)) for name, p in preds.iteritems())
+    ready = [name for name, n in n_preds.iteritems() if n == 0]
+    while ready:
+        name = ready.pop()
+        depth[name] = 1 + max([depth[p] for p in preds[name]] + [-1])
+        for b in succs[name]:
+            n_preds[b] -= 1
+            if n_preds[b] == 0:
+                ready.append(b)
+    if len(depth) < len(cmd):
+        raise ValueError("Cyclic dependancies between the jobs: {}".format(
+                sorted(set(cmd) - set(depth))))
+    groups = {}
+    variants = {}
+    for name in cmd:
+        m = meta.get(name, {})
+        spec = None
+        if native_spec is not None:
+            spec = _native_spec(native_spec, dict(m, memory="{memory}"),
+                                name)
+        key = "{:02d}_{}".format(depth[name], m.get("stage", "job"))
+        variant = (sorted(m.get("env", {}).items()), spec)
+        if variant not in variants.setdefault(key, []):
+            variants[key].append(variant)
+        v = variants[key].index(variant)
+        if v > 0:
+            key += "_{}".format(v)
+        groups.setdefault(key, []).append(name)
+    arrays = []
+    for key in sorted(groups):
+        names = sorted(groups[key], key=lambda n: (
+                [meta.get(n, {}).get(f, -1)
+                 for f in ("outer", "inner", "block", "round")], n))
+        depends = set()
+        for name in names:
+            depends.update(a for a in groups
+                           if set(groups[a]) & preds[name])
+        arrays.append((key, names, sorted(depends)))
+    return arrays
+
+
+def _save_array_jobs(cmd, dep, meta, output_file, native_spec=None,
+                     task_var="SLURM_ARRAY_TASK_ID", first_index=0):
+    """Write one array job (script and tasks table) per group of jobs,
+    a manifest (output_file) and a submission script for SLURM.
+
+    Note: internal function (see save_wf)
+    """
+    import json
+    import pipes
+    root = path.splitext(output_file)[0]
+    array_dir = root + "_arrays"
+    if not path.isdir(array_dir):
+        os.makedirs(array_dir)
+    manifest = {"task_var": task_var, "first_index": first_index,
+                "arrays": []}
+    submit = ["#!/bin/sh", "set -e"]
+    for key, names, depends in _array_groups(cmd, dep, meta,
+                                             native_spec=native_spec):
+        # common prefix of the commands, the table holds the remainder
+        cmds = [cmd[n] for n in names]
+        n_pre = 0
+        while (n_pre < min(len(c) for c in cmds) and
+               all(c[n_pre] == cmds[0][n_pre] for c in cmds)):
+            n_pre += 1
+        table = path.join(array_dir, key + ".tab")
+        with open(table, 'w') as fd:
+            for n, c in zip(names, cmds):
+                m = meta.get(n, {})
+                fd.write(" ".join([str(m.get("outer", "-")),
+                                   str(m.get("inner", "-"))] +
+                                  [pipes.quote(t) for t in c[n_pre:]]) +
+                         "\n")
+        # same environment and native specification (see _array_groups)
+        env = meta.get(names[0], {}).get("env", {})
+        script = path.join(array_dir, key + ".sh")
+        with open(script, 'w') as fd:
+            fd.write("\n".join([
+                        "#!/bin/sh",
+                        "# {}: {} task(s), one line of the table per task "
+                        "(outer inner arguments)".format(key, len(names)),
+                        "TASK=${{1:-${}}}".format(task_var),
+                        "LINE=$(sed -n \"$((TASK - {} + 1))p\" {})".format(
+                            first_index, pipes.quote(table)),
+                        "eval \"set -- $LINE\"",
+                        "export MEMPAMAL_OUTER=$1 MEMPAMAL_INNER=$2",
+                        "shift 2",
+                        " ".join(["exec"] + (["env"] if env else []) +
+                                 ["{}={}".format(e, env[e])
+                                  for e in sorted(env)] +
+                                 [pipes.quote(t)
+                                  for t in cmds[0][:n_pre]] +
+                                 ["\"$@\""])]) + "\n")
+        manifest["arrays"].append({"name": key, "script": script,
+                                   "table": table, "n_tasks": len(names),
+                                   "jobs": names, "depends": depends})
+        # submission with dependency chaining
+        opts = ["--parsable", "--array={}-{}".format(
+                first_index, first_index + len(names) - 1)]
+        if depends:
+            opts.append("--dependency=afterok:" +
+                        ":".join("$J{}".format(d) for d in depends))
+        if native_spec is not None:
+            fields = dict(meta.get(names[0], {}))
+            memory = [meta[n]["memory"] for n in names
+                      if "memory" in meta.get(n, {})]
+            if memory:
+                fields["memory"] = max(memory)
+            opts.append(_native_spec(native_spec, fields, key))
+        submit.append("J{}=$(sbatch {} {})".format(key, " ".join(opts),
+                                                   pipes.quote(script)))
+    with open(output_file, 'w') as fd:
+        json.dump(manifest, fd, indent=True)
+    with open(root + "_submit.sh", 'w') as fd:
+        fd.write("\n".join(submit) + "\n")
+    return manifest
 
 
-def save_wf(wf, output_file, mode="soma-workflow"):
+def save_wf(wf, output_file, mode="soma-workflow", native_spec=None,
+            task_var="SLURM_ARRAY_TASK_ID", first_index=0):
     """Save the workflow in a file.
 
-    Support simple JSON commands list (cmd-list) or soma-workflow.
+    Support simple JSON commands list (cmd-list), soma-workflow or
+    array jobs (array-job): one array job per stage and depth of the
+    workflow, each task reading its arguments (after the command
+    prefix common to the array) from a table indexed by the task ID.
+    The array jobs are described in a JSON manifest (output_file, see
+    runner.run_array_jobs to run them locally) and chained in a SLURM
+    submission script (<output_file root>_submit.sh).
 
     Parameters:
     ----------
-    wf : tuple (cmd-dict, dependancies),
+    wf : tuple (cmd-dict, dependancies[, metadata]),
         Workflow to save.
     output_file : str,
         filename for the workflow.
-    mode : str in ["soma-workflow", "cmd_list"],
+    mode : str in ["soma-workflow", "cmd_list", "array-job"],
            optional (default="soma-workflow")
         format to save the workflow.
+    native_spec : str, optional (default=None)
+        template of the scheduler resources request, formatted with the
+        job metadata (e.g. "-l mem={memory}mb" for PBS, the maximum
+        memory of the tasks for an array job). With the packing of
+        create_wf, node and node_jobs (jobs of the stage sharing the
+        node) are also available. A field missing from the metadata of
+        a job raises a KeyError.
+    task_var : str, optional (default="SLURM_ARRAY_TASK_ID")
+        environment variable with the task ID of an array job (e.g.
+        "PBS_ARRAYID" or "SGE_TASK_ID").
+    first_index : int, optional (default=0)
+        ID of the first task of an array job (1 for SGE).
     """
     cmd = wf[0]
     dep_orig = wf[1]
+    meta = wf[2] if len(wf) > 2 else {}
     if mode == "soma-workflow":
         from soma_workflow.client import Job, Workflow, Helper
         for k, v in cmd.iteritems():
-            cmd[k] = Job(command=v, name=k)
+            kwargs = {}
+            if native_spec is not None and k in meta:
+                kwargs["native_specification"] = _native_spec(
+                    native_spec, meta[k], k)
+            if "env" in meta.get(k, {}):
+                kwargs["env"] = meta[k]["env"]
+            cmd[k] = Job(command=v, name=k, **kwargs)
         dep = [((cmd[a], cmd[b])) for a, b in dep_orig]
         jobs = np.asarray(cmd.values())[np.argsort(cmd.keys())]
         workflow = Workflow(jobs=jobs.tolist(),
@@ -133,9 +711,16 @@ def save_wf(wf, output_file, mode="soma-workflow"):
     elif mode == "cmd-list":
         import json
         for k, v in cmd.iteritems():
-            cmd[k] = " ".join(v)
+            env = meta.get(k, {}).get("env", {})
+            cmd[k] = " ".join(["{}={}".format(e, env[e])
+                               for e in sorted(env)] + v)
         with open(output_file, 'w') as fd:
-            json.dump(dict(cmd=cmd, dep=dep_orig), fd, indent=True)
+            json.dump(dict(cmd=cmd, dep=dep_orig, meta=meta), fd,
+                      indent=True)
         return cmd
+    elif mode == "array-job":
+        return _save_array_jobs(cmd, dep_orig, meta, output_file,
+                                native_spec=native_spec, task_var=task_var,
+                                first_index=first_index)
     else:
         raise TypeError("Invalid workflow mode \'{}\'".format(mode))